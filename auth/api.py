@@ -1,180 +1,505 @@
+import asyncio
+import secrets
 import traceback
-import uuid
-import time
-from typing import Union
-from fastapi import FastAPI, Request, Response, Depends, HTTPException
+from importlib.util import find_spec
+from typing import Union, Optional
+from fastapi import FastAPI, Request, Response, Depends, HTTPException, Header
+from fastapi.responses import StreamingResponse, JSONResponse
 from fastapi.encoders import jsonable_encoder
 from fastapi.security import HTTPBearer
-from sqlalchemy.orm import Session
-
-from config import _APPLICATION, _SWVERSION, _DESCRIPTION
-from utils import logger, _request_uuid_ctx_var, get_request_uuid, reqinspect, get_hashed_password, verify_password, generate_jwt_token, validate_jwt_token
-from schemas import GeneralRespModel, NewUserModel, UserModel, UserChangePasswordModel, TokenRespModel
-from database import SessionLocal, Engine, Base, get_account, create_account, update_account, delete_account
+from starlette.concurrency import run_in_threadpool
+
+from config import _APPLICATION, _SWVERSION, _DESCRIPTION, DB_ASYNC, JWKS_MAX_AGE, ADMIN_KEY, INTROSPECT_KEY, RATELIMIT, FAST_RESPONSE, AUTO_MIGRATE
+from utils import logger, kv, get_request_uuid, reqinspect, debug_sampled, generate_jwt_token, generate_refresh_token, \
+                  parse_refresh_token, validate_jwt_token_cached, keyring
+from schemas import GeneralRespModel, NewUserModel, UserModel, UserChangePasswordModel, TokenRespModel, RefreshTokenModel, \
+                   IntrospectModel, IntrospectRespModel, BulkFormatEnum, BulkImportRespModel, TokenClaims
+from database import SessionLocal, AsyncSessionLocal, Engine, AsyncEngine, Base, release, warmup, async_warmup, pool_stats, replicas, cached_account, get_account, create_account, update_account, delete_account, \
+                     async_get_account, async_create_account, async_update_account, async_delete_account, \
+                     create_refresh_token, consume_refresh_token, delete_refresh_family, \
+                     async_create_refresh_token, async_consume_refresh_token, async_delete_refresh_family
+from claims import account_claims, load_claims, async_load_claims, invalidate_claims
+from hasher import hasher, HasherBusy
+from passwords import needs_rehash
+from cache import CACHES
+from revocation import revocations
+from signing import jwks_document
+from bulk import BulkImport, sync_chunks, textstream, export_lines
+from ratelimit import RateLimitMiddleware
+from tracking import TrackingMiddleware
+import metrics
+from metrics import timed
 
 
 httpapi = FastAPI(title=_APPLICATION, version=_SWVERSION, description=_DESCRIPTION, docs_url='/apidoc', redoc_url=None)
 
-Base.metadata.create_all(bind=Engine)
-
-def dbsession():
-    db = SessionLocal()
+if AUTO_MIGRATE:
+    # missing tables only: the columns are migrated once by main.py before the workers are started,
+    # the workers importing the application concurrently never race on the same ALTER TABLE.
+    # the connection is released, in preload mode the workers forked afterward would share it
+    Base.metadata.create_all(bind=Engine)
+    release(Engine)
+
+if DB_ASYNC:
+    # async mode: database io run natively on the event loop
+    async def dbsession():
+        async with AsyncSessionLocal() as db:
+            yield db
+
+    async def dbcall(func, asyncfunc, *args):
+        with timed('db'):
+            return await asyncfunc(*args)
+else:
+    # sync mode: blocking database functions are pushed to the threadpool
+    def dbsession():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    async def dbcall(func, asyncfunc, *args):
+        with timed('db'):
+            return await run_in_threadpool(func, *args)
+
+
+# readiness of this worker: its connection pool is open, and it is not shutting down
+READY = False
+STOPPING = False
+
+async def warm():
+    global READY
     try:
-        yield db
-    finally:
-        db.close()
+        if DB_ASYNC:
+            await async_warmup()
+        else:
+            await run_in_threadpool(warmup)
+        READY = True
+    except Exception as e:
+        logger.error(kv(module='auth', space='httpapi', action='warmup', exception=e))
 
 
-@httpapi.middleware('http')
-async def tracking(request: Request, call_next) -> Response:
-    try:
-        start_time = time.time()
-        request_uuid = _request_uuid_ctx_var.set(str(uuid.uuid4()))
-        client_ip = request.client.host
-        method = request.method.lower()
-        path = request.url.path
-        response = await call_next(request)
-        status_code = response.status_code
-        process_time = round(time.time() - start_time, 3)
-        logger.info(f'module=auth, space=httpapi, request_id={get_request_uuid()}, client_ip={client_ip}, method={method}, path={path}, status_code={status_code}, process_time={process_time}')
-        _request_uuid_ctx_var.reset(request_uuid)
-        return response
-    except:
-        pass
+@httpapi.on_event('startup')
+async def startup():
+    # run by each worker, after the fork in preload mode: the revocations of the other workers are pulled from now on
+    revocations.start()
+    await warm()
+
+
+def stopping():
+    # called by the server on SIGTERM, ahead of its shutdown: /ready fails while the requests are still served
+    global READY, STOPPING
+    READY, STOPPING = False, True
+
+
+@httpapi.on_event('shutdown')
+async def shutdown():
+    stopping()
+    hasher.shutdown()
+    # the pooled connections are closed, those of aiosqlite run in non-daemon threads which would hold the exit
+    if DB_ASYNC:
+        await AsyncEngine.dispose()
+    Engine.dispose()
+    if replicas is not None:
+        await replicas.dispose()
 
 
-def JWTBearer(authcredentials=Depends(HTTPBearer(scheme_name='Authorization'))):
+if RATELIMIT:
+    # added before tracking, so tracking wraps it
+    httpapi.add_middleware(RateLimitMiddleware)
+
+
+# registered last, the outermost middleware: it tracks every request, including the rate limited ones
+httpapi.add_middleware(TrackingMiddleware)
+
+
+def reqdebug(function, request, reqbody, result):
+    # request and body are only serialized when the debug record is actually emitted
+    if debug_sampled(request.scope['path']):
+        logger.debug(kv(module='auth', space='httpapi', request_id=get_request_uuid(), function=function, request=reqinspect(request), body=jsonable_encoder(reqbody), result=result))
+
+
+async def JWTBearer(authcredentials=Depends(HTTPBearer(scheme_name='Authorization'))):
     # a reusable middleware function for specify api
-    # validate the jwt token, pass to api or raise error
+    # validate the jwt token, pass its claims to api or raise error
     if authcredentials:
         if not authcredentials.scheme == "Bearer":
             raise HTTPException(status_code=403, detail="invalid authentication scheme")
 
-        payload = validate_jwt_token(authcredentials.credentials)
+        with timed('jwt_decode'):
+            payload = validate_jwt_token_cached(authcredentials.credentials)
         if not payload:
             raise HTTPException(status_code=403, detail="expired token or invalid token")
 
-        # might add the blocklist/backlist here to cover immediate and secure case of
-        # change password, deleted/suppend user, permissions ...
-        return payload
+        # in-memory lookup, tokens issued before a change password or deleted user are rejected
+        if revocations.is_revoked(payload):
+            raise HTTPException(status_code=403, detail="revoked token")
+        # signature verified, the claims are trusted as is
+        return TokenClaims.construct(**payload)
     else:
         raise HTTPException(status_code=403, detail="invalid authorization")
 
 
+async def AdminKey(x_admin_key: Optional[str] = Header(None)):
+    # admin api is disabled when ADMIN_KEY is not set
+    if not ADMIN_KEY or not x_admin_key or not secrets.compare_digest(x_admin_key, ADMIN_KEY):
+        raise HTTPException(status_code=403, detail="invalid admin key")
+
+
+async def IntrospectKey(x_introspect_key: Optional[str] = Header(None)):
+    # a batch is up to INTROSPECT_MAX_BATCH signature verifications and tells whether a token is valid,
+    # only for the gateways holding the key
+    if not INTROSPECT_KEY or not x_introspect_key or not secrets.compare_digest(x_introspect_key, INTROSPECT_KEY):
+        raise HTTPException(status_code=403, detail="invalid introspect key")
+
+
+def introspect_tokens(tokens):
+    # verdict of every token with the JWTBearer rules, duplicates are verified once
+    verdicts = {}
+    with timed('jwt_decode'):
+        for token in tokens:
+            if token in verdicts:
+                continue
+            payload = validate_jwt_token_cached(token)
+            if not payload:
+                verdicts[token] = {'active': False, 'detail': 'expired token or invalid token'}
+            elif revocations.is_revoked(payload):
+                verdicts[token] = {'active': False, 'detail': 'revoked token'}
+            else:
+                verdicts[token] = {'active': True, 'claims': payload}
+    return [verdicts[token] for token in tokens]
+
+
+if find_spec('orjson'):
+    from fastapi.responses import ORJSONResponse as FastJSONResponse
+else:
+    # standard json encoder, still without validation nor jsonable_encoder
+    FastJSONResponse = JSONResponse
+
+# field names of the response models, in declaration order, with their required fields
+RESPONSE_SHAPES = {model: ({name: None for name in model.__fields__}, {name for name, field in model.__fields__.items() if field.required})
+                   for model in [GeneralRespModel, TokenRespModel]}
+
+def reply(response, result, *models):
+    # FAST_RESPONSE: the result, already built by the handler, is sent as the first model it fits:
+    # same fields and order as the model would produce, without validation nor jsonable_encoder.
+    # the response_model of the route is kept, so the openapi schema does not change.
+    if not FAST_RESPONSE:
+        return result
+    for model in models:
+        fields, required = RESPONSE_SHAPES[model]
+        if required <= result.keys():
+            return FastJSONResponse({**fields, **result}, status_code=response.status_code, headers=response.headers)
+    return result
+
+
+HEALTH_RESPONSE = b'"OK"'
+
+
 #---------------------------------------------------------------------------------------------------------------------------
 # API VIEW
 #---------------------------------------------------------------------------------------------------------------------------
 
 @httpapi.get("/health")
-def health():
+async def health():
+    if FAST_RESPONSE:
+        return Response(HEALTH_RESPONSE, media_type='application/json')
     return "OK"
 
 
+@httpapi.get("/ready", response_model=GeneralRespModel)
+async def ready(response: Response):
+    # /health tells the process is alive, /ready that this worker can take traffic
+    if not READY and not STOPPING:
+        # the database was unreachable at startup, retried by the probe
+        await warm()
+    if READY:
+        return {'status': 'passed'}
+    response.status_code = 503
+    return {'status': 'failed', 'detail': 'stopping' if STOPPING else 'database unavailable'}
+
+
+if metrics.ENABLED:
+    @httpapi.get("/metrics", include_in_schema=False)
+    def prometheus():
+        return Response(metrics.render(), media_type=metrics.CONTENT_TYPE_LATEST)
+
+
+JWKS_BODY, JWKS_ETAG = jwks_document(keyring)
+
+@httpapi.get("/.well-known/jwks.json")
+async def jwks(request: Request):
+    # public keys of the token signature, gateways verify the tokens locally and refetch the document on unknown kid
+    headers = {'Cache-Control': f'public, max-age={JWKS_MAX_AGE}', 'ETag': JWKS_ETAG}
+    if request.headers.get('if-none-match') == JWKS_ETAG:
+        return Response(status_code=304, headers=headers)
+    return Response(JWKS_BODY, media_type='application/json', headers=headers)
+
+
+@httpapi.get("/stats/dbpool", include_in_schema=False)
+async def dbpool():
+    # database connection pool usage of the worker serving this request
+    stats = pool_stats(AsyncEngine if DB_ASYNC else Engine)
+    if replicas is not None:
+        stats['replicas'] = replicas.stats()
+    return stats
+
+
+@httpapi.get("/stats/caches", include_in_schema=False)
+async def caches():
+    # in-process caches of the worker serving this request
+    return {name: cache.stats() for name, cache in CACHES.items()}
+
+
+async def revoke(email, function):
+    # the account write is committed and the not-before applied by this worker before it is published:
+    # a failing backend is logged, the change is not reported as failed. the other workers learn a revocation from the
+    # backend they poll every REVOCATION_SYNC_INTERVAL: an unpublished one is never seen there, the tokens stay valid until expiry
+    try:
+        await run_in_threadpool(revocations.revoke, email)
+    except Exception as e:
+        logger.error(kv(module='auth', space='httpapi', request_id=get_request_uuid(), function=function, action='revoke', exception=e, traceback=traceback.format_exc()))
+
+
 @httpapi.post("/auth/register", response_model=GeneralRespModel, status_code=200)
-def register(reqbody: NewUserModel, request: Request, response: Response, dbsess: Session = Depends(dbsession)):
+async def register(reqbody: NewUserModel, request: Request, response: Response, dbsess=Depends(dbsession)):
     try:
         email = reqbody.email
         password = reqbody.password
 
-        if get_account(dbsess, email):
+        # an existing email is refused before the hashing: repeated duplicate registrations never take the hasher
+        # from the logins. the lookup reads the primary, the unique index of the insert still decides on a race
+        if cached_account(email) or await dbcall(get_account, async_get_account, dbsess, email):
             response.status_code, result = 409, {'status': 'failed', 'detail': 'existing user'}
             return
 
-        hpassword = get_hashed_password(password)
-        create_account(dbsess, email, hpassword)
+        hpassword = await hasher.async_hash_password(password)
+        if not await dbcall(create_account, async_create_account, dbsess, email, hpassword):
+            response.status_code, result = 409, {'status': 'failed', 'detail': 'existing user'}
+            return
+        # a new email has no token to revoke, its unknown email cached by the other workers expires after ACCOUNT_CACHE_NEGATIVE_TTL.
+        # an email deleted within the token lifetime is published again: the other workers evict the account they cached
+        if revocations.known(email):
+            await revoke(email, 'user_register')
         response.status_code, result = 200, {'status': 'passed'}
+    except HasherBusy:
+        response.status_code, result = 503, {'status': 'failed', 'detail': 'service busy'}
+        response.headers['Retry-After'] = '1'
     except Exception as e:
         response.status_code, result = 500, {'status': 'failed', 'detail': 'Internal Server Error'}
-        logger.error(f'module=auth, space=httpapi, request_id={get_request_uuid()}, function=user_register, exception={e}, traceback={traceback.format_exc()}')
+        logger.error(kv(module='auth', space='httpapi', request_id=get_request_uuid(), function='user_register', exception=e, traceback=traceback.format_exc()))
     finally:
-        logger.debug(f'module=auth, space=httpapi, request_id={get_request_uuid()}, function=user_register, request={reqinspect(request)}, body={jsonable_encoder(reqbody)}, result={result}')
+        reqdebug('user_register', request, reqbody, result)
         return result
 
 
+async def rehash(dbsess, account, password):
+    # the hash of an outdated scheme or cost is replaced once the password is verified,
+    # best effort: the login never fails on it, the upgrade is retried on the next login
+    try:
+        hpassword = await hasher.async_hash_password(password)
+        # a password changed meanwhile is kept, the update then matches no row
+        if not await dbcall(update_account, async_update_account, dbsess, account, hpassword):
+            return
+        logger.info(kv(module='auth', space='httpapi', request_id=get_request_uuid(), function='user_login', action='rehash', email=account.email))
+    except HasherBusy:
+        pass
+    except Exception as e:
+        logger.warning(kv(module='auth', space='httpapi', request_id=get_request_uuid(), function='user_login', action='rehash', exception=e))
+
+
+async def verified_account(dbsess, email, password):
+    # account of the email and the result of its password check. the hash is always read from the primary: the account
+    # cache and the replicas may hold the previous password, or a deleted account, until they catch up
+    account = await dbcall(get_account, async_get_account, dbsess, email)
+    if not account:
+        return None, False
+    return account, await hasher.async_verify_password(password, account.hpassword)
+
+
 @httpapi.post("/auth/login", response_model=Union[TokenRespModel, GeneralRespModel], status_code=200)
-def login(reqbody: UserModel, request: Request, response: Response, dbsess: Session = Depends(dbsession)):
+async def login(reqbody: UserModel, request: Request, response: Response, dbsess=Depends(dbsession)):
     try:
         email = reqbody.email
         password = reqbody.password
-        _account = get_account(dbsess, email)
+        _account, verified = await verified_account(dbsess, email, password)
 
         if not _account:
             response.status_code, result = 404, {'status': 'failed', 'detail': 'user not found'}
             return
 
-        if not verify_password(password, _account.hpassword):
+        if not verified:
             response.status_code, result = 403, {'status': 'failed', 'detail': 'wrong password or email address'}
             return
 
-        token = generate_jwt_token(email)
-        response.status_code, result = 200, {'status': 'passed', 'token': token}
+        with timed('jwt_encode'):
+            # claims from the account just loaded, cached for the refresh of this session
+            token = generate_jwt_token(email, account_claims(_account))
+            refresh_token, jti, family, expiry = generate_refresh_token()
+        await dbcall(create_refresh_token, async_create_refresh_token, dbsess, jti, family, email, expiry)
+        if needs_rehash(_account.hpassword):
+            await rehash(dbsess, _account, password)
+        response.status_code, result = 200, {'status': 'passed', 'token': token, 'refresh_token': refresh_token}
+    except HasherBusy:
+        response.status_code, result = 503, {'status': 'failed', 'detail': 'service busy'}
+        response.headers['Retry-After'] = '1'
+    except Exception as e:
+        response.status_code, result = 500, {'status': 'failed', 'detail': 'Internal Server Error'}
+        logger.error(kv(module='auth', space='httpapi', requestid=get_request_uuid(), function='user_login', exception=e, traceback=traceback.format_exc()))
+    finally:
+        reqdebug('user_login', request, reqbody, result)
+        return reply(response, result, TokenRespModel, GeneralRespModel)
+
+
+@httpapi.post("/auth/refresh", response_model=Union[TokenRespModel, GeneralRespModel], status_code=200)
+async def refresh(reqbody: RefreshTokenModel, request: Request, response: Response, dbsess=Depends(dbsession)):
+    # renew the session token without password: single use of the opaque refresh token by primary key
+    try:
+        parsed = parse_refresh_token(reqbody.refresh_token)
+        if not parsed:
+            response.status_code, result = 403, {'status': 'failed', 'detail': 'expired token or invalid token'}
+            return
+
+        jti, family = parsed
+        email = await dbcall(consume_refresh_token, async_consume_refresh_token, dbsess, jti, family)
+        if not email:
+            # a rotated token is presented again, it may be stolen: the whole family is revoked
+            await dbcall(delete_refresh_family, async_delete_refresh_family, dbsess, family)
+            logger.warning(kv(module='auth', space='httpapi', request_id=get_request_uuid(), function='token_refresh', action='revoke_family', family=family))
+            response.status_code, result = 403, {'status': 'failed', 'detail': 'expired token or invalid token'}
+            return
+
+        claims = await dbcall(load_claims, async_load_claims, dbsess, email)
+        if claims is None:
+            response.status_code, result = 403, {'status': 'failed', 'detail': 'expired token or invalid token'}
+            return
+
+        with timed('jwt_encode'):
+            token = generate_jwt_token(email, claims)
+            refresh_token, jti, family, expiry = generate_refresh_token(family)
+        await dbcall(create_refresh_token, async_create_refresh_token, dbsess, jti, family, email, expiry)
+        response.status_code, result = 200, {'status': 'passed', 'token': token, 'refresh_token': refresh_token}
     except Exception as e:
         response.status_code, result = 500, {'status': 'failed', 'detail': 'Internal Server Error'}
-        logger.error(f'module=auth, space=httpapi, requestid={get_request_uuid()}, function=user_login, exception={e}, traceback={traceback.format_exc()}')
+        logger.error(kv(module='auth', space='httpapi', request_id=get_request_uuid(), function='token_refresh', exception=e, traceback=traceback.format_exc()))
     finally:
-        logger.debug(f'module=auth, space=httpapi, requestid={get_request_uuid()}, function=user_login, request={reqinspect(request)}, body={jsonable_encoder(reqbody)}, result={result}')
+        reqdebug('token_refresh', request, reqbody, result)
+        return result
+
+
+@httpapi.post("/auth/introspect", response_model=Union[IntrospectRespModel, GeneralRespModel], status_code=200, dependencies=[Depends(IntrospectKey)])
+async def introspect(reqbody: IntrospectModel, request: Request, response: Response):
+    # batch of bearer tokens verified in a single request, the whole batch run in one threadpool call
+    try:
+        response.status_code, result = 200, {'results': await run_in_threadpool(introspect_tokens, reqbody.tokens)}
+    except Exception as e:
+        response.status_code, result = 500, {'status': 'failed', 'detail': 'Internal Server Error'}
+        logger.error(kv(module='auth', space='httpapi', request_id=get_request_uuid(), function='token_introspect', exception=e, traceback=traceback.format_exc()))
+    finally:
+        # tokens are bearer credentials, only their count is logged
+        reqdebug('token_introspect', request, {'tokens': len(reqbody.tokens)}, result)
         return result
 
 
 @httpapi.put("/auth/users", status_code=200, response_model=GeneralRespModel, dependencies=[Depends(JWTBearer)])
-def change_password(reqbody: UserChangePasswordModel, request: Request, response: Response, dbsess: Session = Depends(dbsession), jwtpayload=Depends(JWTBearer)):
+async def change_password(reqbody: UserChangePasswordModel, request: Request, response: Response, dbsess=Depends(dbsession), claims: TokenClaims = Depends(JWTBearer)):
     try:
         email = reqbody.email
         current_password = reqbody.current_password
         new_password = reqbody.new_password
-        jwtemail = jwtpayload.get('email')
 
-        if email != jwtemail:
+        if email != claims.email:
             response.status_code, result = 400, {'status': 'failed', 'detail': 'bad request'}
             return
 
-        # use these code for this time to check if user is still active
-        # but consider to use token blocklist or similar thing for deleted/logged-out user.
-        _account = get_account(dbsess, email)
+        _account, verified = await verified_account(dbsess, email, current_password)
         if not _account:
             response.status_code, result = 404, {'status': 'failed', 'detail': 'user not found'}
             return
 
-        if not verify_password(current_password, _account.hpassword):
+        if not verified:
             response.status_code, result = 403, {'status': 'failed', 'detail': 'current password is not corect'}
             return
 
-        hpassword = get_hashed_password(new_password)
-        update_account(dbsess, _account, hpassword)
+        hpassword = await hasher.async_hash_password(new_password)
+        # the password and the refresh tokens in one transaction, only if the account is unchanged since verified
+        if not await dbcall(update_account, async_update_account, dbsess, _account, hpassword, True):
+            response.status_code, result = 409, {'status': 'failed', 'detail': 'account was modified, retry'}
+            return
+        invalidate_claims(email)
+        await revoke(email, 'change_password')
         response.status_code, result = 200, {'status': 'passed'}
+    except HasherBusy:
+        response.status_code, result = 503, {'status': 'failed', 'detail': 'service busy'}
+        response.headers['Retry-After'] = '1'
     except Exception as e:
         response.status_code, result = 500, {'status': 'failed', 'detail': 'Internal Server Error'}
-        logger.error(f'module=auth, space=httpapi, request_id={get_request_uuid()}, function=change_password, exception={e}, traceback={traceback.format_exc()}')
+        logger.error(kv(module='auth', space='httpapi', request_id=get_request_uuid(), function='change_password', exception=e, traceback=traceback.format_exc()))
     finally:
-        logger.debug(f'module=auth, space=httpapi, request_id={get_request_uuid()}, function=change_password, request={reqinspect(request)}, body={jsonable_encoder(reqbody)}, result={result}')
+        reqdebug('change_password', request, reqbody, result)
         return result
 
 
 @httpapi.delete("/auth/users", status_code=200, response_model=GeneralRespModel, dependencies=[Depends(JWTBearer)], include_in_schema=False)
-def delete_user(reqbody: UserModel, request: Request, response: Response, dbsess: Session = Depends(dbsession), jwtpayload=Depends(JWTBearer)):
+async def delete_user(reqbody: UserModel, request: Request, response: Response, dbsess=Depends(dbsession), claims: TokenClaims = Depends(JWTBearer)):
     try:
         email = reqbody.email
         password = reqbody.password
-        jwtemail = jwtpayload.get('email')
 
-        if email != jwtemail:
+        if email != claims.email:
             response.status_code, result = 400, {'status': 'failed', 'detail': 'bad request'}
             return
 
-        _account = get_account(dbsess, email)
+        _account, verified = await verified_account(dbsess, email, password)
         if not _account:
             response.status_code, result = result = 200, {'status': 'passed'}
             return
 
-        if not verify_password(password, _account.hpassword):
+        if not verified:
             response.status_code, result = 403, {'status': 'failed', 'detail': 'password is not corect'}
             return
 
-        delete_account(dbsess, _account)
+        if not await dbcall(delete_account, async_delete_account, dbsess, _account):
+            response.status_code, result = 409, {'status': 'failed', 'detail': 'account was modified, retry'}
+            return
+        invalidate_claims(email)
+        await revoke(email, 'delete_user')
         response.status_code, result = 200, {'status': 'passed'}
+    except HasherBusy:
+        response.status_code, result = 503, {'status': 'failed', 'detail': 'service busy'}
+        response.headers['Retry-After'] = '1'
     except Exception as e:
         response.status_code, result = 500, {'status': 'failed', 'detail': 'Internal Server Error'}
-        logger.error(f'module=auth, space=httpapi, request_id={get_request_uuid()}, function=delete_user, exception={e}, traceback={traceback.format_exc()}')
+        logger.error(kv(module='auth', space='httpapi', request_id=get_request_uuid(), function='delete_user', exception=e, traceback=traceback.format_exc()))
     finally:
-        logger.debug(f'module=auth, space=httpapi, request_id={get_request_uuid()}, function=delete_user, request={reqinspect(request)}, body={jsonable_encoder(reqbody)}, result={result}')
+        reqdebug('delete_user', request, reqbody, result)
         return result
+
+
+#---------------------------------------------------------------------------------------------------------------------------
+# ADMIN API
+#---------------------------------------------------------------------------------------------------------------------------
+
+@httpapi.post("/admin/users/import", response_model=BulkImportRespModel, status_code=200, dependencies=[Depends(AdminKey)])
+async def users_import(request: Request, response: Response, format: BulkFormatEnum = BulkFormatEnum.ndjson):
+    # the body is streamed to the importer running in the threadpool, the body chunks are received through the event loop
+    # for large imports prefer the manage.py cli, the import only gets a share of the hasher workers, the rest serve the logins
+    dbsess = SessionLocal()
+    importer = BulkImport(dbsess, format.value)
+    try:
+        lines = textstream(sync_chunks(request.stream(), asyncio.get_event_loop()))
+        await run_in_threadpool(importer.feed, lines)
+        response.status_code, result = 200, {'status': 'passed', **importer.stats}
+    except Exception as e:
+        response.status_code, result = 500, {'status': 'failed', 'detail': 'Internal Server Error', **importer.stats}
+        logger.error(kv(module='auth', space='httpapi', request_id=get_request_uuid(), function='users_import', exception=e, traceback=traceback.format_exc()))
+    finally:
+        dbsess.close()
+        return result
+
+
+@httpapi.get("/admin/users/export", dependencies=[Depends(AdminKey)])
+def users_export(format: BulkFormatEnum = BulkFormatEnum.ndjson):
+    # streamed from a server side cursor, the memory usage does not depend on the number of accounts
+    media_type = 'text/csv' if format == BulkFormatEnum.csv else 'application/x-ndjson'
+    return StreamingResponse(export_lines(format.value), media_type=media_type)
@@ -0,0 +1,29 @@
+# run the whole benchmark suite and write one json document, to compare results across commits
+# usage, from the auth directory: python3 -m benchmarks [--quick] [--load] [--output benchmark.json]
+import json
+import argparse
+
+from benchmarks.common import metadata, report
+from benchmarks import bench_funcs, bench_database, bench_middleware, loadtest
+
+
+parser = argparse.ArgumentParser(description='auth benchmark suite')
+parser.add_argument('--quick', action='store_true', help='fewer iterations, for a smoke run')
+parser.add_argument('--load', action='store_true', help='include the http load test on a local server')
+parser.add_argument('--output', default='benchmark.json')
+args = parser.parse_args()
+
+scale = 10 if args.quick else 1
+suites = {
+    'functions': bench_funcs.run(10000 // scale),
+    'database': bench_database.run(5000 // scale),
+    'middleware': bench_middleware.run(5000 // scale),
+}
+if args.load:
+    suites['loadtest'] = loadtest.run(duration=10 / scale)
+
+for suite, results in suites.items():
+    report(suite, results)
+with open(args.output, 'w') as f:
+    json.dump({'meta': metadata(), 'suites': suites}, f, indent=2)
+print(f'results written to {args.output}')
@@ -0,0 +1,84 @@
+# per-call cost of the orm data access (baseline) versus the precompiled core statements of database.py
+# runs against an in-memory sqlite database, the mysql server is not required
+# usage, from the auth directory: python3 -m benchmarks.bench_database [--iterations N] [--output FILE]
+import argparse
+
+from benchmarks.common import measure, report
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from database import Base, AccountBase, get_account, update_account, create_account, create_accounts, existing_emails
+
+
+HPASSWORD = '$2b$12$ElKEYvzzbadvQEn39F7xdOuZfR0qRDdYykfJTr4YgR8OkF.wc0f3G'
+
+
+def orm_get_account(dbsess, email):
+    return dbsess.query(AccountBase).filter(AccountBase.email == email).first()
+
+
+def orm_update_account(dbsess, email, hpassword):
+    account = orm_get_account(dbsess, email)
+    setattr(account, 'hpassword', hpassword)
+    dbsess.add(account)
+    dbsess.commit()
+    dbsess.refresh(account)
+
+
+def core_update_account(dbsess, email, hpassword):
+    update_account(dbsess, get_account(dbsess, email), hpassword)
+
+
+def lookup_register(dbsess, email):
+    # previous register flow: lookup, then insert
+    if not get_account(dbsess, email):
+        create_account(dbsess, email, HPASSWORD)
+
+
+def row_by_row_import(dbsess, emails):
+    # register flow repeated per account: lookup then insert, one commit per account
+    for email in emails:
+        if not get_account(dbsess, email):
+            create_account(dbsess, email, HPASSWORD)
+
+
+def chunk_import(dbsess, emails):
+    # bulk import flow: one IN query and one multi-row INSERT for the chunk
+    existing = existing_emails(dbsess, emails)
+    create_accounts(dbsess, [(email, HPASSWORD) for email in emails if email not in existing])
+
+
+def run(iterations=5000):
+    engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    dbsess = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    emails = [f'user{i}@example.com' for i in range(1000)]
+    dbsess.execute(AccountBase.__table__.insert(), [{'email': email, 'hpassword': HPASSWORD} for email in emails])
+    dbsess.commit()
+
+    lookups = [(dbsess, email) for email in emails]
+    updates = [(dbsess, email, HPASSWORD) for email in emails]
+    # import cost of a chunk of 100 new accounts, bcrypt excluded, every call import new emails
+    counter = iter(range(10**9))
+    newchunk = lambda: [f'bulk{next(counter)}@example.com' for _ in range(100)]
+    newemails = (f'new{i}@example.com' for i in counter)
+    return {
+        'import_100(row)': measure(lambda: row_by_row_import(dbsess, newchunk()), [()], max(3, iterations // 500)),
+        'import_100(chunk)': measure(lambda: chunk_import(dbsess, newchunk()), [()], max(3, iterations // 500)),
+        'get_account(orm)': measure(orm_get_account, lookups, iterations),
+        'get_account(core)': measure(get_account, lookups, iterations),
+        'get+update_account(orm)': measure(orm_update_account, updates, iterations),
+        'get+update_account(core)': measure(core_update_account, updates, iterations),
+        # register of a new email, bcrypt excluded
+        'register(select+insert)': measure(lambda: lookup_register(dbsess, next(newemails)), [()], iterations),
+        'register(insert)': measure(lambda: create_account(dbsess, next(newemails), HPASSWORD), [()], iterations),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='orm versus core data access benchmark')
+    parser.add_argument('--iterations', type=int, default=5000)
+    parser.add_argument('--output', help='json result file')
+    args = parser.parse_args()
+    report('database', run(args.iterations), args.output)
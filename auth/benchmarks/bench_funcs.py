@@ -0,0 +1,75 @@
+# micro-benchmarks of the cpu bound helpers: jwt, input validation and bcrypt at several cost factors
+# usage, from the auth directory: python3 -m benchmarks.bench_funcs [--iterations N] [--output FILE]
+import re
+import argparse
+import tempfile
+import bcrypt
+
+from benchmarks.common import measure, report
+from utils import generate_jwt_token, validate_jwt_token
+from schemas import TokenClaims
+from validation import EMAIL_REGEX, PASSWORD_REGEX, check_email_format, check_password_format
+import signing
+import passwords
+from ratelimit import LocalCounters, SharedCounters
+
+
+EMAILS = ['alice@example.com', 'john.doe+test@sub.example.org', 'invalid-email@', 'a' * 64 + '@' + 'b' * 180 + '.com']
+PASSWORDS = ['P@ssw0rdOK', 'PASSWORD', 'p@ss', 'Aa1!' * 8, '1' * 1000]
+BCRYPT_ROUNDS = [4, 8, 10, 12]
+CLAIMS = {'uid': 123456, 'roles': ['user', 'billing'], 'ver': 2}
+
+
+def run(iterations=10000):
+    token = generate_jwt_token(EMAILS[0])
+    results = {
+        'generate_jwt_token': measure(generate_jwt_token, [(email,) for email in EMAILS], iterations),
+        'validate_jwt_token': measure(validate_jwt_token, [(token,)], iterations),
+        'validate_jwt_token(invalid)': measure(validate_jwt_token, [(token[:-2],)], iterations),
+        # token with the claims of the account, and the typed claims given to the handlers by JWTBearer
+        'generate_jwt_token(claims)': measure(generate_jwt_token, [(email, CLAIMS) for email in EMAILS], iterations),
+        'token_claims': measure(lambda payload: TokenClaims.construct(**payload), [(validate_jwt_token(generate_jwt_token(EMAILS[0], CLAIMS)),)], iterations),
+        'check_email_format': measure(check_email_format, [(email,) for email in EMAILS], iterations * 10),
+        'check_password_format': measure(check_password_format, [(password,) for password in PASSWORDS], iterations * 10),
+        # previous checks, through the pattern cache of re and without length check
+        'check_email_format(re.match)': measure(lambda email: bool(re.match(EMAIL_REGEX, email)), [(email,) for email in EMAILS], iterations * 10),
+        'check_password_format(re.match)': measure(lambda password: bool(re.match(PASSWORD_REGEX, password)), [(password,) for password in PASSWORDS], iterations * 10),
+    }
+    # per request cost of the rate limit, 2 hits (ip and email) for a login
+    with tempfile.TemporaryDirectory() as tmpdir:
+        keys = [(f'ip:10.0.{i // 256}.{i % 256}', 10**9, 0) for i in range(10000)]
+        results['ratelimit_hit(local)'] = measure(LocalCounters().hit, keys, iterations)
+        results['ratelimit_hit(shared)'] = measure(SharedCounters(path=f'{tmpdir}/ratelimit').hit, keys, iterations)
+    if signing.CRYPTOGRAPHY:
+        # signature cost of the asymmetric algorithms, verification is what the gateways pay per request
+        from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
+        keys = {'RS256': rsa.generate_private_key(public_exponent=65537, key_size=2048),
+                'ES256': ec.generate_private_key(ec.SECP256R1()),
+                'EdDSA': ed25519.Ed25519PrivateKey.generate()}
+        for algorithm, key in keys.items():
+            keyring = signing.KeyRing(algorithm)
+            keyring.add_key('bench', key)
+            keyring.use('bench', key)
+            signed = keyring.sign({'email': EMAILS[0]})
+            results[f'jwt_sign({algorithm})'] = measure(keyring.sign, [({'email': EMAILS[0]},)], iterations // 10)
+            results[f'jwt_verify({algorithm})'] = measure(keyring.verify, [(signed,)], iterations // 10)
+    for rounds in BCRYPT_ROUNDS:
+        # bcrypt cost double with each round, keep the total time bounded
+        count = max(3, iterations >> rounds)
+        hashed = bcrypt.hashpw(b'P@ssw0rdOK', bcrypt.gensalt(rounds))
+        results[f'bcrypt_hash(rounds={rounds})'] = measure(lambda: bcrypt.hashpw(b'P@ssw0rdOK', bcrypt.gensalt(rounds)), [()], count)
+        results[f'bcrypt_verify(rounds={rounds})'] = measure(bcrypt.checkpw, [(b'P@ssw0rdOK', hashed)], count)
+    # alternative schemes with the configured parameters, to compare with bcrypt at the same cost budget
+    schemes = [passwords.ScryptScheme()] + ([passwords.Argon2Scheme()] if passwords.argon2 is not None else [])
+    for scheme in schemes:
+        hashed = scheme.hash('P@ssw0rdOK')
+        results[f'{scheme.name.lower()}_verify(configured)'] = measure(scheme.verify, [('P@ssw0rdOK', hashed)], 3)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='micro-benchmarks of the auth helpers')
+    parser.add_argument('--iterations', type=int, default=10000)
+    parser.add_argument('--output', help='json result file')
+    args = parser.parse_args()
+    report('functions', run(args.iterations), args.output)
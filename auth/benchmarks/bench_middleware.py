@@ -0,0 +1,137 @@
+# per request overhead of the tracking middleware: BaseHTTPMiddleware (baseline) versus pure asgi middleware,
+# on /health and on an authenticated route (token verified, rejected by the handler before database and bcrypt).
+# FAST_RESPONSE: precomputed /health and the login response serialization, with and without response model.
+# the application is called directly over asgi, no server nor http client is involved.
+# usage, from the auth directory: python3 -m benchmarks.bench_middleware [--iterations N] [--output FILE]
+import json
+import time
+import uuid
+import asyncio
+import argparse
+from contextlib import AsyncExitStack
+from time import perf_counter
+
+from benchmarks.common import summarize, report
+from starlette.exceptions import ExceptionMiddleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import JSONResponse, Response
+from fastapi.routing import serialize_response
+
+import api
+from api import httpapi, reply
+from schemas import TokenRespModel, GeneralRespModel
+from tracking import TrackingMiddleware
+from utils import logger, kv, _request_uuid_ctx_var, get_request_uuid, generate_jwt_token
+from metrics import REQUESTS, REQUEST_LATENCY
+
+
+async def legacy_tracking(request, call_next):
+    # tracking middleware before the pure asgi rewrite
+    try:
+        start_time = time.time()
+        request_uuid = _request_uuid_ctx_var.set(str(uuid.uuid4()))
+        client_ip = request.client.host
+        method = request.method.lower()
+        path = request.url.path
+        response = await call_next(request)
+        status_code = response.status_code
+        elapsed = time.time() - start_time
+        process_time = round(elapsed, 3)
+        endpoint = request.scope.get('endpoint')
+        handler = endpoint.__name__ if endpoint else 'none'
+        REQUESTS.labels(handler, method, status_code).inc()
+        REQUEST_LATENCY.labels(handler, method).observe(elapsed)
+        logger.info(kv(module='auth', space='httpapi', request_id=get_request_uuid(), client_ip=client_ip, method=method, path=path, status_code=status_code, process_time=process_time))
+        _request_uuid_ctx_var.reset(request_uuid)
+        return response
+    except:
+        pass
+
+
+def httpscope(method, path, headers=()):
+    return {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method, 'scheme': 'http',
+            'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+            'headers': [(name.encode(), value.encode()) for name, value in headers],
+            'client': ('127.0.0.1', 50000), 'server': ('127.0.0.1', 8000)}
+
+
+async def call(app, scope, body):
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+    async def receive():
+        # the body, then wait for a disconnect which never come, as a server does
+        if messages:
+            return messages.pop()
+        await asyncio.Future()
+
+    async def send(message):
+        pass
+
+    # the router updates the scope, each request gets its own, with the exit stack of the yield dependencies
+    # normally set by FastAPI.__call__
+    async with AsyncExitStack() as stack:
+        await app(dict(scope, fastapi_astack=stack), receive, send)
+
+
+async def measure_app(app, scope, body, iterations):
+    latencies = []
+    start = perf_counter()
+    for _ in range(iterations):
+        t = perf_counter()
+        await call(app, scope, body)
+        latencies.append(perf_counter() - t)
+    return summarize(latencies, perf_counter() - start)
+
+
+async def run_async(iterations):
+    # the stack of httpapi without its user middlewares, wrapped by each variant
+    inner = ExceptionMiddleware(httpapi.router, handlers=httpapi.exception_handlers)
+    apps = {
+        'none': inner,
+        'basehttp': BaseHTTPMiddleware(inner, dispatch=legacy_tracking),
+        'asgi': TrackingMiddleware(inner),
+    }
+    token = generate_jwt_token('bench@example.com')
+    body = json.dumps({'email': 'other@example.com', 'current_password': 'P@ssw0rdOK', 'new_password': 'P@ssw0rdOK'}).encode()
+    requests = {
+        'health': (httpscope('GET', '/health'), b''),
+        'auth_users': (httpscope('PUT', '/auth/users', [('authorization', f'Bearer {token}'), ('content-type', 'application/json')]), body),
+    }
+    results = {}
+    for name, (scope, body) in requests.items():
+        for variant, app in apps.items():
+            # warm up, then measure
+            await measure_app(app, scope, body, 100)
+            results[f'{name}({variant})'] = await measure_app(app, scope, body, iterations)
+
+    # FAST_RESPONSE: precomputed /health, and the login response without validation nor jsonable_encoder
+    api.FAST_RESPONSE = True
+    results['health(asgi,fast)'] = await measure_app(apps['asgi'], requests['health'][0], b'', iterations)
+    result = {'status': 'passed', 'token': token, 'refresh_token': token}
+    field = next(route for route in httpapi.routes if getattr(route, 'path', None) == '/auth/login').secure_cloned_response_field
+    for variant, fast in [('model', False), ('fast', True)]:
+        api.FAST_RESPONSE = fast
+        latencies = []
+        start = perf_counter()
+        for _ in range(iterations):
+            t = perf_counter()
+            if fast:
+                reply(Response(), result, TokenRespModel, GeneralRespModel).body
+            else:
+                JSONResponse(await serialize_response(field=field, response_content=result)).body
+            latencies.append(perf_counter() - t)
+        results[f'login_response({variant})'] = summarize(latencies, perf_counter() - start)
+    api.FAST_RESPONSE = False
+    return results
+
+
+def run(iterations=5000):
+    return asyncio.run(run_async(iterations))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='tracking middleware overhead benchmark')
+    parser.add_argument('--iterations', type=int, default=5000)
+    parser.add_argument('--output', help='json result file')
+    args = parser.parse_args()
+    report('middleware', run(args.iterations), args.output)
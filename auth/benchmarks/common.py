@@ -0,0 +1,63 @@
+# shared helpers of the benchmark suite, to be imported before any module of the auth service
+import os
+import sys
+import json
+import platform
+import subprocess
+from time import perf_counter, time
+
+# local run: no mysql server nor secret required
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('LOGLEVEL', 'ERROR')
+
+
+def percentile(ordered, rate):
+    # nearest-rank percentile of an already sorted list
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(rate * len(ordered)))]
+
+
+def summarize(latencies, elapsed):
+    # latencies in second, result in microsecond
+    ordered = sorted(latencies)
+    return {
+        'count': len(ordered),
+        'throughput': round(len(ordered) / elapsed, 1) if elapsed else 0.0,
+        'mean_us': round(sum(ordered) / len(ordered) * 1e6, 2) if ordered else 0.0,
+        'p50_us': round(percentile(ordered, .50) * 1e6, 2),
+        'p95_us': round(percentile(ordered, .95) * 1e6, 2),
+        'p99_us': round(percentile(ordered, .99) * 1e6, 2),
+    }
+
+
+def measure(func, args, iterations):
+    # call func iterations times, cycling through the args list
+    latencies = []
+    start = perf_counter()
+    for i in range(iterations):
+        t = perf_counter()
+        func(*args[i % len(args)])
+        latencies.append(perf_counter() - t)
+    return summarize(latencies, perf_counter() - start)
+
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        commit = None
+    return {'commit': commit, 'timestamp': int(time()), 'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+
+def report(suite, results, output=None):
+    # print a table and write the machine readable results, one json document per suite run
+    print(f'{suite:<28} {"count":>8} {"ops/s":>10} {"p50(us)":>10} {"p95(us)":>10} {"p99(us)":>10}')
+    for name, stats in results.items():
+        print(f'{name:<28} {stats["count"]:>8} {stats["throughput"]:>10} {stats["p50_us"]:>10} {stats["p95_us"]:>10} {stats["p99_us"]:>10}')
+    if output:
+        document = {'suite': suite, 'meta': metadata(), 'results': results}
+        with open(output, 'w') as f:
+            json.dump(document, f, indent=2)
+        print(f'results written to {output}', file=sys.stderr)
@@ -0,0 +1,134 @@
+# concurrent http load driver for /auth/login and the authenticated /auth/users route
+# without --url, a local server is started with uvicorn on a temporary sqlite database
+# usage, from the auth directory:
+#   python3 -m benchmarks.loadtest [--url http://host:port] [--concurrency 16] [--duration 10] [--workers 1] [--output FILE]
+import os
+import sys
+import json
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from time import perf_counter, sleep
+from urllib.parse import urlsplit
+
+from benchmarks.common import summarize, report
+
+
+EMAIL = 'loadtest@example.com'
+PASSWORD = 'P@ssw0rdOK'
+
+
+class Client:
+    # keep-alive http connection, one per driver thread
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+
+    def request(self, method, path, body=None, token=None):
+        headers = {'Content-Type': 'application/json'}
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        self.connection.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+        response = self.connection.getresponse()
+        return response.status, response.read()
+
+
+def scenarios(token):
+    # name -> (method, path, body, token, expected status)
+    return {
+        'login': ('POST', '/auth/login', {'email': EMAIL, 'password': PASSWORD}, None, 200),
+        # email mismatch is rejected right after the jwt verification: no bcrypt, no database
+        'users(authenticated)': ('PUT', '/auth/users', {'email': 'other@example.com', 'current_password': PASSWORD, 'new_password': PASSWORD}, token, 400),
+        'health': ('GET', '/health', None, None, 200),
+    }
+
+
+def drive(url, scenario, concurrency, duration):
+    method, path, body, token, expected = scenario
+    latencies, statuses, lock = [], {}, threading.Lock()
+    deadline = perf_counter() + duration
+
+    def worker():
+        client, local, counts = Client(url), [], {}
+        while perf_counter() < deadline:
+            start = perf_counter()
+            try:
+                status, _ = client.request(method, path, body, token)
+            except Exception:
+                status, client = 'error', Client(url)
+            local.append(perf_counter() - start)
+            counts[str(status)] = counts.get(str(status), 0) + 1
+        with lock:
+            latencies.extend(local)
+            for status, count in counts.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = summarize(latencies, perf_counter() - start)
+    # eg: 503 on login once the password hashing pool is saturated
+    stats['statuses'] = statuses
+    stats['unexpected'] = sum(count for status, count in statuses.items() if status != str(expected))
+    return stats
+
+
+def freeport():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve(workers):
+    # local server on a temporary sqlite database, returns the process and its url
+    port = freeport()
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{tempfile.mkdtemp()}/loadtest.db')
+    process = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'api:httpapi', '--port', str(port), '--workers', str(workers), '--log-level', 'error'], env=env)
+    url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            if Client(url).request('GET', '/health')[0] == 200:
+                return process, url
+        except OSError:
+            sleep(0.1)
+    process.terminate()
+    raise RuntimeError('local server did not start')
+
+
+def run(url=None, concurrency=16, duration=10, workers=1):
+    process = None
+    if not url:
+        process, url = serve(workers)
+    try:
+        client = Client(url)
+        client.request('POST', '/auth/register', {'email': EMAIL, 'password': PASSWORD})
+        status, body = client.request('POST', '/auth/login', {'email': EMAIL, 'password': PASSWORD})
+        if status != 200:
+            raise RuntimeError(f'login failed with status {status}')
+        token = json.loads(body)['token']
+        return {name: drive(url, scenario, concurrency, duration) for name, scenario in scenarios(token).items()}
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='http load test of the auth service')
+    parser.add_argument('--url', help='target server, a local one is started when omitted')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10, help='second per scenario')
+    parser.add_argument('--workers', type=int, default=1, help='workers of the local server')
+    parser.add_argument('--output', help='json result file')
+    args = parser.parse_args()
+    results = run(args.url, args.concurrency, args.duration, args.workers)
+    report('loadtest', results, args.output)
+    for name, stats in results.items():
+        if stats['unexpected']:
+            print(f'{name}: unexpected responses, statuses={stats["statuses"]}', file=sys.stderr)
@@ -0,0 +1,177 @@
+import io
+import csv
+import json
+import asyncio
+from collections import deque
+from sqlalchemy.exc import IntegrityError
+
+from config import BULK_CHUNK_SIZE
+from utils import logger, kv
+from validation import check_email_format, check_password_format
+from database import SessionLocal, existing_emails, create_account, create_accounts, stream_accounts
+from hasher import hasher, hashpw
+from passwords import policy
+
+
+FORMATS = ['ndjson', 'csv']
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class BulkImport:
+    # streaming import of accounts, the input is consumed chunk by chunk:
+    # one IN query to skip the existing emails, the passwords of the chunk hashed in parallel
+    # by the shared hasher, then one multi-row INSERT committed per chunk.
+    # input records: {"email": ..., "password": ...} or {"email": ..., "hpassword": <hash>},
+    # exported accounts are re-imported with their hash, upgraded to the current scheme on their next login
+    def __init__(self, dbsess, format='ndjson', chunksize=BULK_CHUNK_SIZE, share=None):
+        self.dbsess = dbsess
+        self.format = format
+        self.chunksize = chunksize
+        # at most share hashes in flight on the hasher, default half of its workers, the rest is left to the logins
+        self.share = min(share or max(1, hasher.workers // 2), hasher.capacity)
+        self.stats = {'imported': 0, 'existing': 0, 'invalid': 0}
+
+    def parse(self, lines):
+        # malformed record is yielded as None and counted as invalid
+        if self.format == 'csv':
+            # one reader over the whole stream, the lines keep their ending so quoted newlines are preserved
+            rows = csv.reader(lines)
+            fieldnames = next(rows, None)
+            for row in rows:
+                if row:
+                    yield dict(zip(fieldnames, row))
+        else:
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                yield record if isinstance(record, dict) else None
+
+    def feed(self, lines):
+        # lines: the whole input as iterable of text lines with their ending, eg: a file opened with newline=''
+        for chunk in chunked(self.parse(lines), self.chunksize):
+            self.import_chunk(chunk)
+        return self.stats
+
+    def import_chunk(self, records):
+        accounts = {}
+        for record in records:
+            email = record.get('email') if record else None
+            password = record.get('password') if record else None
+            hpassword = record.get('hpassword') if record else None
+            if not isinstance(email, str) or not check_email_format(email):
+                self.stats['invalid'] += 1
+            elif email in accounts:
+                self.stats['existing'] += 1
+            elif isinstance(hpassword, str) and len(hpassword) <= 255 and policy.identify(hpassword):
+                # a hash of a supported scheme is stored as is, anything else is never stored
+                accounts[email] = (None, hpassword)
+            elif isinstance(password, str) and check_password_format(password):
+                accounts[email] = (password, None)
+            else:
+                self.stats['invalid'] += 1
+        if not accounts:
+            return
+
+        existing = existing_emails(self.dbsess, accounts)
+        self.stats['existing'] += len(existing)
+        accounts = {email: passwords for email, passwords in accounts.items() if email not in existing}
+        plains = [password for password, hpassword in accounts.values() if hpassword is None]
+        hashed = self.hash_passwords(plains)
+        rows = [(email, hpassword if hpassword is not None else next(hashed)) for email, (password, hpassword) in accounts.items()]
+        if not rows:
+            return
+        try:
+            create_accounts(self.dbsess, rows)
+            imported = len(rows)
+        except IntegrityError:
+            # an email registered since the check, or equal to another one under the collation of the database
+            # (letter case on mysql): the chunk is inserted row by row, the unique index decides for each
+            self.dbsess.rollback()
+            created = [create_account(self.dbsess, email, hpassword) for email, hpassword in rows]
+            imported = created.count(True)
+            self.stats['existing'] += created.count(False)
+        self.stats['imported'] += imported
+        logger.info(kv(module='auth', space='bulk', action='import', **self.stats))
+
+    def hash_passwords(self, plains):
+        # hashes in order, the submit wait for a free slot of the hasher instead of being rejected
+        pending = deque()
+        for plain in plains:
+            if len(pending) >= self.share:
+                yield pending.popleft().result()
+            pending.append(hasher.submit(hashpw, plain, wait=True))
+        while pending:
+            yield pending.popleft().result()
+
+
+class ChunkStream(io.RawIOBase):
+    # file object over an iterable of bytes, eg: the request body, read as text with textstream
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            self.pending = next(self.chunks, None)
+            if self.pending is None:
+                self.pending = b''
+                return 0
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+def sync_chunks(achunks, loop):
+    # chunks of an async stream, eg: request.stream(), pulled from a worker thread through the event loop
+    achunks = achunks.__aiter__()
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(achunks.__anext__(), loop).result()
+        except StopAsyncIteration:
+            return
+
+
+def textstream(chunks):
+    # utf-8 text lines of a byte stream, same as a file opened with newline=''
+    return io.TextIOWrapper(io.BufferedReader(ChunkStream(chunks)), encoding='utf-8', newline='')
+
+
+def export_lines(format='ndjson', chunksize=BULK_CHUNK_SIZE):
+    # accounts as ndjson or csv lines, with their hash so the export can be imported elsewhere
+    dbsess = SessionLocal()
+    try:
+        if format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator='\n')
+            writer.writerow(['email', 'hpassword'])
+            for rows in chunked(stream_accounts(dbsess, chunksize), chunksize):
+                writer.writerows(rows)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            if buffer.getvalue():
+                yield buffer.getvalue()
+        else:
+            for rows in chunked(stream_accounts(dbsess, chunksize), chunksize):
+                yield ''.join(json.dumps({'email': email, 'hpassword': hpassword}) + '\n' for email, hpassword in rows)
+    finally:
+        dbsess.close()
@@ -0,0 +1,91 @@
+from config import CLAIMS, CLAIMS_CACHE_SIZE, CLAIMS_CACHE_TTL
+from utils import logger, kv
+from cache import TTLCache
+from database import get_account, async_get_account
+
+
+# claims pipeline: each enricher maps an account to extra claims of the session token, the CLAIMS enrichers
+# are applied in order. downstream services, and JWTBearer, read them from the verified token without any lookup.
+# a new claim is added by registering an enricher, eg:
+#   @enricher('tenant')
+#   def account_tenant(account):
+#       return {'tenant': ...}
+ENRICHERS = {}
+
+# claims of the token itself, never overridden by an enricher
+RESERVED_CLAIMS = {'iat', 'iat_ms', 'exp', 'email', 'jti'}
+
+
+def enricher(name):
+    def register(func):
+        ENRICHERS[name] = func
+        return func
+    return register
+
+
+@enricher('uid')
+def account_id(account):
+    return {'uid': account.id}
+
+
+@enricher('roles')
+def account_roles(account):
+    return {'roles': account.roles.split(',') if account.roles else []}
+
+
+@enricher('ver')
+def account_token_version(account):
+    return {'ver': account.token_version}
+
+
+def pipeline(names=CLAIMS):
+    enrichers = []
+    for name in names:
+        if name in ENRICHERS:
+            enrichers.append(ENRICHERS[name])
+        else:
+            logger.warning(kv(module='auth', space='claims', error='unknown claims enricher', name=name))
+    return enrichers
+
+
+enrichers = pipeline()
+
+# claims by email, filled at login from the account already loaded, so /auth/refresh does not look the account up
+claims_cache = TTLCache('claims', CLAIMS_CACHE_SIZE, CLAIMS_CACHE_TTL) if CLAIMS_CACHE_SIZE else None
+
+
+def account_claims(account):
+    claims = {}
+    for func in enrichers:
+        claims.update(func(account))
+    for name in RESERVED_CLAIMS & claims.keys():
+        del claims[name]
+    if claims_cache is not None:
+        claims_cache.set(account.email, claims)
+    return claims
+
+
+def load_claims(dbsess, email):
+    # claims of the account, None when the account does not exist anymore
+    if not enrichers:
+        return {}
+    claims = claims_cache.get(email) if claims_cache is not None else None
+    if claims is None:
+        account = get_account(dbsess, email, stale=True)
+        claims = account_claims(account) if account else None
+    return claims
+
+
+async def async_load_claims(dbsess, email):
+    if not enrichers:
+        return {}
+    claims = claims_cache.get(email) if claims_cache is not None else None
+    if claims is None:
+        account = await async_get_account(dbsess, email, stale=True)
+        claims = account_claims(account) if account else None
+    return claims
+
+
+def invalidate_claims(email):
+    if claims_cache is not None:
+        claims_cache.delete(email)
@@ -1,20 +1,103 @@
-from time import time
-from sqlalchemy import create_engine, Column, Integer, String
+import itertools
+import threading
+from time import time, perf_counter, monotonic
+from sqlalchemy import create_engine, inspect, select, bindparam, Column, Integer, BigInteger, String
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError, IntegrityError, SQLAlchemyError
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool, StaticPool
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 
-from config import MYSQL_USER, MYSQL_PASSWORD, MYSQL_DB, MYSQL_HOST, MYSQL_PORT
-from utils import logger
+from config import MYSQL_USER, MYSQL_PASSWORD, MYSQL_DB, MYSQL_HOST, MYSQL_PORT, DATABASE_URL, DB_ASYNC, \
+                   DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING, \
+                   ACCOUNT_CACHE_SIZE, ACCOUNT_CACHE_TTL, ACCOUNT_CACHE_NEGATIVE_TTL, \
+                   DATABASE_REPLICA_URLS, REPLICA_POLICY, REPLICA_STICKY_SECONDS, REPLICA_RETRY_INTERVAL
+from utils import logger, kv
+from cache import TTLCache
+from metrics import DBPOOL_WAIT, DBPOOL_INUSE, DBPOOL_OVERFLOWS, DBPOOL_TIMEOUTS, ACCOUNT_READS
 
 
-if not (MYSQL_USER and MYSQL_PASSWORD and MYSQL_HOST and MYSQL_DB):
-    logger.critical('module=auth, space=database, error=Please specify MYSQL_USER, MYSQL_PASSWORD, MYSQL_HOST, MYSQL_DB')
+if not (DATABASE_URL or (MYSQL_USER and MYSQL_PASSWORD and MYSQL_HOST and MYSQL_DB)):
+    logger.critical(kv(module='auth', space='database', error='Please specify MYSQL_USER, MYSQL_PASSWORD, MYSQL_HOST, MYSQL_DB'))
     exit()
 
-DATABASE_URL = f'mysql+pymysql://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_HOST}:{MYSQL_PORT}/{MYSQL_DB}'
+if not DATABASE_URL:
+    DATABASE_URL = f'mysql+pymysql://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_HOST}:{MYSQL_PORT}/{MYSQL_DB}'
+
+def async_url(url):
+    # same database through the asyncio driver
+    return url.replace('mysql+pymysql://', 'mysql+aiomysql://', 1).replace('sqlite://', 'sqlite+aiosqlite://', 1)
+
+ASYNC_DATABASE_URL = async_url(DATABASE_URL)
+
+
+class MeteredPool:
+    # connection pool mixin that record the checkout wait time, overflow and timeout events
+    # counters are reset when the pool is recreated (engine dispose)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._metrics = {'checkouts': 0, 'wait_total': 0.0, 'wait_max': 0.0, 'overflows': 0, 'timeouts': 0}
+        self._metrics_lock = threading.Lock()
+
+    def _do_get(self):
+        start = perf_counter()
+        overflow = self._overflow
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            with self._metrics_lock:
+                self._metrics['timeouts'] += 1
+            DBPOOL_TIMEOUTS.inc()
+            raise
+        wait = perf_counter() - start
+        overflowed = self._overflow > overflow and self._overflow > 0
+        with self._metrics_lock:
+            self._metrics['checkouts'] += 1
+            self._metrics['wait_total'] += wait
+            if wait > self._metrics['wait_max']:
+                self._metrics['wait_max'] = wait
+            if overflowed:
+                self._metrics['overflows'] += 1
+        DBPOOL_WAIT.observe(wait)
+        DBPOOL_INUSE.inc()
+        if overflowed:
+            DBPOOL_OVERFLOWS.inc()
+        return connection
+
+    def _do_return_conn(self, record):
+        DBPOOL_INUSE.dec()
+        super()._do_return_conn(record)
+
+
+class MeteredQueuePool(MeteredPool, QueuePool):
+    pass
+
+
+class MeteredAsyncQueuePool(MeteredPool, AsyncAdaptedQueuePool):
+    pass
+
+
+POOL_OPTIONS = {
+    'pool_size': DB_POOL_SIZE,
+    'max_overflow': DB_MAX_OVERFLOW,
+    'pool_timeout': DB_POOL_TIMEOUT,
+    'pool_recycle': DB_POOL_RECYCLE,
+    'pool_pre_ping': DB_POOL_PRE_PING,
+}
+
+
+def engine_options(url, poolclass):
+    if not url.startswith('sqlite'):
+        return dict(poolclass=poolclass, **POOL_OPTIONS)
+    # sqlite, the local stand-in of mysql: connections are shared by the threadpool
+    # and an in-memory database only lives as long as its single connection
+    if url in ['sqlite://', 'sqlite+aiosqlite://'] or ':memory:' in url:
+        return dict(poolclass=StaticPool, connect_args={'check_same_thread': False})
+    return dict(poolclass=poolclass, connect_args={'check_same_thread': False}, **POOL_OPTIONS)
+
 
 # create a sql engine instance
-Engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+Engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL, MeteredQueuePool))
 
 # create a declarativeMeta instance
 Base = declarative_base()
@@ -22,6 +105,114 @@ Base = declarative_base()
 # create SessionLocal class from sessionmaker factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=Engine)
 
+# async engine and session factory, the sync engine is still kept for schema creation
+AsyncEngine = None
+AsyncSessionLocal = None
+if DB_ASYNC:
+    try:
+        from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+    except ImportError as e:
+        logger.critical(kv(module='auth', space='database', error='DB_ASYNC require sqlalchemy asyncio extension and aiomysql', exception=e))
+        exit()
+
+    AsyncEngine = create_async_engine(ASYNC_DATABASE_URL, **engine_options(ASYNC_DATABASE_URL, MeteredAsyncQueuePool))
+    # expire_on_commit disabled, attributes access after commit must not trigger implicit io
+    AsyncSessionLocal = sessionmaker(autoflush=False, expire_on_commit=False, bind=AsyncEngine, class_=AsyncSession)
+
+
+def checkedout(engine):
+    pool = getattr(engine, 'sync_engine', engine).pool
+    return pool.checkedout() if isinstance(pool, QueuePool) else 0
+
+
+class ReplicaSet:
+    # read-only engines of the replicas, for the account lookups which tolerate the replication lag (claims of
+    # /auth/refresh). writes and password checks stay on the primary. an account written by this worker, or by another
+    # one once learnt by the revocation sync, is read from the primary during the sticky delay, so a lagging replica
+    # does not serve the claims of a deleted account. an account not found on a replica is looked up on the primary
+    # (registered but not replicated yet), a failing replica (error, pool timeout) is skipped for the retry interval.
+    def __init__(self, urls, policy=REPLICA_POLICY, sticky=REPLICA_STICKY_SECONDS, retry=REPLICA_RETRY_INTERVAL, async_engines=DB_ASYNC):
+        self.urls = urls
+        self.policy = policy
+        self.retry = retry
+        self.engines = [create_engine(url, **engine_options(url, MeteredQueuePool)) for url in urls]
+        self.async_engines = [create_async_engine(async_url(url), **engine_options(async_url(url), MeteredAsyncQueuePool)) for url in urls] if async_engines else []
+        self.recent = TTLCache('replica_sticky', 100000, sticky) if sticky else None
+        self._down = [0.0] * len(urls)
+        self._counter = itertools.count()
+
+    def pick(self, engines):
+        # index of an available replica, None when all of them are failing
+        now = monotonic()
+        candidates = [index for index in range(len(engines)) if self._down[index] <= now]
+        if not candidates:
+            return None
+        if self.policy == 'LEAST_CONNECTIONS':
+            return min(candidates, key=lambda index: checkedout(engines[index]))
+        return candidates[next(self._counter) % len(candidates)]
+
+    def wrote(self, email):
+        if self.recent is not None:
+            self.recent.set(email, True)
+
+    def sticky(self, email):
+        return self.recent is not None and self.recent.get(email) is not None
+
+    def failed(self, index, e):
+        self._down[index] = monotonic() + self.retry
+        ACCOUNT_READS.labels('replica_error').inc()
+        logger.warning(kv(module='auth', space='database', action='replica_down', replica=index, retry=self.retry, exception=e))
+
+    def first(self, statement, params):
+        # first row of the statement on a replica, None when not found or no replica available
+        index = self.pick(self.engines)
+        if index is None:
+            return None
+        try:
+            with self.engines[index].connect() as connection:
+                return connection.execute(statement, params).first()
+        except SQLAlchemyError as e:
+            self.failed(index, e)
+            return None
+
+    async def async_first(self, statement, params):
+        index = self.pick(self.async_engines)
+        if index is None:
+            return None
+        try:
+            async with self.async_engines[index].connect() as connection:
+                return (await connection.execute(statement, params)).first()
+        except SQLAlchemyError as e:
+            self.failed(index, e)
+            return None
+
+    def stats(self):
+        return [pool_stats(engine) for engine in (self.async_engines or self.engines)]
+
+    async def dispose(self):
+        for engine in self.async_engines:
+            await engine.dispose()
+        for engine in self.engines:
+            engine.dispose()
+
+
+replicas = ReplicaSet(DATABASE_REPLICA_URLS) if DATABASE_REPLICA_URLS else None
+
+
+def pool_stats(engine=Engine):
+    # snapshot of the connection pool usage of this process
+    pool = getattr(engine, 'sync_engine', engine).pool
+    if not isinstance(pool, QueuePool):
+        return {}
+
+    stats = {'size': pool.size(), 'checkedout': pool.checkedout(), 'checkedin': pool.checkedin(), 'overflow': max(pool.overflow(), 0)}
+    metrics = getattr(pool, '_metrics', None)
+    if metrics:
+        with pool._metrics_lock:
+            stats.update(metrics)
+        stats['wait_avg'] = stats['wait_total'] / stats['checkouts'] if stats['checkouts'] else 0.0
+    return stats
+
 
 class AccountBase(Base):
     __tablename__ = 'accounts'
@@ -32,27 +223,352 @@ class AccountBase(Base):
     email = Column(String(320), unique=True, index=True)
     # bcrypt output max lenght is 60 bytes
     # string type is good enough with compare hashes on python layer
-    hpassword = Column(String(60))
+    # bcrypt hash is 60 characters, argon2id and scrypt hashes are longer
+    hpassword = Column(String(255))
+    # embedded in the session token by the claims pipeline: comma separated roles, and a version bumped by
+    # every password change so downstream services can tell a token issued before it
+    roles = Column(String(255))
+    token_version = Column(Integer, nullable=False, server_default='0')
+
+
+class AccountRecord:
+    # lightweight snapshot of an account row, detached from any session so it is safe
+    # to be shared by concurrent requests through the account cache
+    __slots__ = ('id', 'email', 'hpassword', 'roles', 'token_version')
+
+    def __init__(self, id, email, hpassword, roles=None, token_version=0):
+        self.id = id
+        self.email = email
+        self.hpassword = hpassword
+        self.roles = roles
+        self.token_version = token_version
+
+
+ACCOUNTS = AccountBase.__table__
+
+# core statements of the account hot path, built once at import: sqlalchemy caches their compiled form,
+# each call only binds parameters, no orm instance nor identity map is involved
+SELECT_ACCOUNT = select(ACCOUNTS.c.id, ACCOUNTS.c.email, ACCOUNTS.c.hpassword, ACCOUNTS.c.roles, ACCOUNTS.c.token_version).where(ACCOUNTS.c.email == bindparam('email'))
+INSERT_ACCOUNT = ACCOUNTS.insert().values(email=bindparam('email'), hpassword=bindparam('hpassword'))
+# writes are conditional on the hash the password was verified against: an account changed or deleted
+# by a concurrent request is not overwritten, the statement matches no row instead
+UPDATE_ACCOUNT = ACCOUNTS.update().where(ACCOUNTS.c.email == bindparam('account_email'), ACCOUNTS.c.hpassword == bindparam('old_hpassword')) \
+                                  .values(hpassword=bindparam('new_hpassword'))
+# password change by the user: the token version is bumped along
+UPDATE_PASSWORD = UPDATE_ACCOUNT.values(token_version=ACCOUNTS.c.token_version + 1)
+DELETE_ACCOUNT = ACCOUNTS.delete().where(ACCOUNTS.c.email == bindparam('account_email'), ACCOUNTS.c.hpassword == bindparam('old_hpassword'))
+
+# read-through account cache keyed by email, unknown email is cached as False (negative caching)
+account_cache = TTLCache('account', ACCOUNT_CACHE_SIZE, ACCOUNT_CACHE_TTL) if ACCOUNT_CACHE_SIZE else None
+
+def cached_account(email: str):
+    # return the cached account, False for a cached unknown email, None on cache miss
+    if account_cache is None:
+        return None
+    return account_cache.get(email)
 
 
-def get_account(dbsess: Session, email: str):
-    return dbsess.query(AccountBase).filter(AccountBase.email == email).first()
+def cache_account(email: str, account):
+    if account_cache is not None:
+        if account:
+            account_cache.set(email, account)
+        else:
+            account_cache.set(email, False, ACCOUNT_CACHE_NEGATIVE_TTL)
+
+
+def invalidate_account(email: str):
+    # called on every write of the account, and by the revocation sync for the writes of the other workers
+    if account_cache is not None:
+        account_cache.delete(email)
+    if replicas is not None:
+        replicas.wrote(email)
+
+
+def get_account(dbsess: Session, email: str, stale: bool = False):
+    # stale: the lookup tolerates an outdated account, served by the cache or a read replica (claims of /auth/refresh).
+    # the cache of a worker does not see the writes of the other ones until the revocation sync evicts them, a password
+    # is never checked against a stale account. a cached unknown email is served to every lookup.
+    account = cached_account(email)
+    if account is False or (account and stale):
+        return account or None
+
+    if stale and replicas is not None and not replicas.sticky(email):
+        row = replicas.first(SELECT_ACCOUNT, {'email': email})
+        if row:
+            # a replica row may be stale, it is not cached where a password check would read it
+            ACCOUNT_READS.labels('replica').inc()
+            return AccountRecord(*row)
+    ACCOUNT_READS.labels('primary').inc()
+    row = dbsess.execute(SELECT_ACCOUNT, {'email': email}).first()
+    account = AccountRecord(*row) if row else None
+    cache_account(email, account)
+    return account
 
 
 def create_account(dbsess: Session, email: str, hpassword: str):
-    account = AccountBase(email=email, hpassword=hpassword)
-    dbsess.add(account)
+    # no lookup before the insert, the unique index on email decides: False for an existing email,
+    # concurrent registrations of the same email can not both succeed
+    try:
+        dbsess.execute(INSERT_ACCOUNT, {'email': email, 'hpassword': hpassword})
+        dbsess.commit()
+    except IntegrityError:
+        dbsess.rollback()
+        return False
+    finally:
+        invalidate_account(email)
+    return True
+
+
+def update_account(dbsess: Session, account: AccountRecord, hpassword: str, logout: bool = False):
+    # False when the account was changed or deleted since it was read,
+    # logout: the token version is bumped and the refresh tokens of the account are deleted in the same transaction
+    result = dbsess.execute(UPDATE_PASSWORD if logout else UPDATE_ACCOUNT, {'account_email': account.email, 'old_hpassword': account.hpassword, 'new_hpassword': hpassword})
+    if logout and result.rowcount == 1:
+        dbsess.execute(DELETE_REFRESH_TOKENS, {'subject': account.email})
     dbsess.commit()
-    dbsess.refresh(account)
+    invalidate_account(account.email)
+    return result.rowcount == 1
+
+
+def delete_account(dbsess: Session, account: AccountRecord):
+    # account and its refresh tokens in one transaction, False when the account was changed or deleted since it was read
+    result = dbsess.execute(DELETE_ACCOUNT, {'account_email': account.email, 'old_hpassword': account.hpassword})
+    if result.rowcount == 1:
+        dbsess.execute(DELETE_REFRESH_TOKENS, {'subject': account.email})
+    dbsess.commit()
+    invalidate_account(account.email)
+    return result.rowcount == 1
+
+
+# set based statements of the bulk import/export
+SELECT_EXISTING_EMAILS = select(ACCOUNTS.c.email).where(ACCOUNTS.c.email.in_(bindparam('emails', expanding=True)))
+SELECT_ALL_ACCOUNTS = select(ACCOUNTS.c.email, ACCOUNTS.c.hpassword).order_by(ACCOUNTS.c.id)
+
+def existing_emails(dbsess: Session, emails):
+    # one IN query for the whole chunk
+    return {row[0] for row in dbsess.execute(SELECT_EXISTING_EMAILS, {'emails': list(emails)})}
 
 
-def update_account(dbsess: Session, account: AccountBase, hpassword: str):
-    setattr(account, 'hpassword', hpassword)
-    dbsess.add(account)
+def create_accounts(dbsess: Session, accounts):
+    # accounts: list of (email, hpassword), inserted by one multi-row INSERT in a single transaction
+    dbsess.execute(ACCOUNTS.insert().values([{'email': email, 'hpassword': hpassword} for email, hpassword in accounts]))
     dbsess.commit()
-    dbsess.refresh(account)
+    for email, _ in accounts:
+        invalidate_account(email)
+
+
+def stream_accounts(dbsess: Session, size: int):
+    # server side cursor, the rows are fetched by partition of size so memory stays flat
+    result = dbsess.execute(SELECT_ALL_ACCOUNTS.execution_options(stream_results=True))
+    for partition in result.partitions(size):
+        yield from partition
+
+
+async def async_get_account(dbsess, email: str, stale: bool = False):
+    account = cached_account(email)
+    if account is False or (account and stale):
+        return account or None
+
+    if stale and replicas is not None and not replicas.sticky(email):
+        row = await replicas.async_first(SELECT_ACCOUNT, {'email': email})
+        if row:
+            ACCOUNT_READS.labels('replica').inc()
+            return AccountRecord(*row)
+    ACCOUNT_READS.labels('primary').inc()
+    result = await dbsess.execute(SELECT_ACCOUNT, {'email': email})
+    row = result.first()
+    account = AccountRecord(*row) if row else None
+    cache_account(email, account)
+    return account
+
+
+async def async_create_account(dbsess, email: str, hpassword: str):
+    try:
+        await dbsess.execute(INSERT_ACCOUNT, {'email': email, 'hpassword': hpassword})
+        await dbsess.commit()
+    except IntegrityError:
+        await dbsess.rollback()
+        return False
+    finally:
+        invalidate_account(email)
+    return True
+
+
+async def async_update_account(dbsess, account: AccountRecord, hpassword: str, logout: bool = False):
+    result = await dbsess.execute(UPDATE_PASSWORD if logout else UPDATE_ACCOUNT, {'account_email': account.email, 'old_hpassword': account.hpassword, 'new_hpassword': hpassword})
+    if logout and result.rowcount == 1:
+        await dbsess.execute(DELETE_REFRESH_TOKENS, {'subject': account.email})
+    await dbsess.commit()
+    invalidate_account(account.email)
+    return result.rowcount == 1
+
+
+async def async_delete_account(dbsess, account: AccountRecord):
+    result = await dbsess.execute(DELETE_ACCOUNT, {'account_email': account.email, 'old_hpassword': account.hpassword})
+    if result.rowcount == 1:
+        await dbsess.execute(DELETE_REFRESH_TOKENS, {'subject': account.email})
+    await dbsess.commit()
+    invalidate_account(account.email)
+    return result.rowcount == 1
+
+
+class RevocationBase(Base):
+    # per-user revocation: every token of subject issued at or before notbefore (in millisecond) is rejected
+    # the row is useless once expiry (in second) passed since all these tokens are expired as well
+    __tablename__ = 'revocations'
+    id = Column(Integer, primary_key=True)
+    subject = Column(String(320))
+    notbefore = Column(BigInteger, index=True)
+    expiry = Column(Integer, index=True)
+
+
+def create_revocation(dbsess: Session, subject: str, notbefore: int, expiry: int):
+    dbsess.add(RevocationBase(subject=subject, notbefore=notbefore, expiry=expiry))
+    dbsess.commit()
+
+
+def get_revocations(dbsess: Session, since: int, now: int):
+    return dbsess.query(RevocationBase.subject, RevocationBase.notbefore, RevocationBase.expiry) \
+                 .filter(RevocationBase.notbefore >= since, RevocationBase.expiry > now).all()
+
+
+def delete_revocations(dbsess: Session, now: int):
+    dbsess.query(RevocationBase).filter(RevocationBase.expiry <= now).delete(synchronize_session=False)
+    dbsess.commit()
+
+
+class RefreshTokenBase(Base):
+    # issued refresh tokens not yet used, a row is consumed (deleted) on rotation.
+    # jti is the digest of the secret of the opaque token, the token itself is never stored
+    __tablename__ = 'refresh_tokens'
+    jti = Column(String(32), primary_key=True)
+    family = Column(String(32), index=True)
+    subject = Column(String(320), index=True)
+    expiry = Column(Integer)
+
+
+REFRESH_TOKENS = RefreshTokenBase.__table__
+
+INSERT_REFRESH_TOKEN = REFRESH_TOKENS.insert().values(jti=bindparam('jti'), family=bindparam('family'), subject=bindparam('subject'), expiry=bindparam('expiry'))
+DELETE_EXPIRED_REFRESH_TOKENS = REFRESH_TOKENS.delete().where(REFRESH_TOKENS.c.subject == bindparam('subject'), REFRESH_TOKENS.c.expiry <= bindparam('now'))
+SELECT_REFRESH_TOKEN = select(REFRESH_TOKENS.c.subject).where(REFRESH_TOKENS.c.jti == bindparam('jti'), REFRESH_TOKENS.c.family == bindparam('family'),
+                                                              REFRESH_TOKENS.c.expiry > bindparam('now'))
+CONSUME_REFRESH_TOKEN = REFRESH_TOKENS.delete().where(REFRESH_TOKENS.c.jti == bindparam('jti'))
+DELETE_REFRESH_FAMILY = REFRESH_TOKENS.delete().where(REFRESH_TOKENS.c.family == bindparam('family'))
+DELETE_REFRESH_TOKENS = REFRESH_TOKENS.delete().where(REFRESH_TOKENS.c.subject == bindparam('subject'))
+
+
+def create_refresh_token(dbsess: Session, jti: str, family: str, subject: str, expiry: int):
+    # expired tokens of the subject are purged along, abandoned sessions do not pile up
+    dbsess.execute(DELETE_EXPIRED_REFRESH_TOKENS, {'subject': subject, 'now': int(time())})
+    dbsess.execute(INSERT_REFRESH_TOKEN, {'jti': jti, 'family': family, 'subject': subject, 'expiry': expiry})
+    dbsess.commit()
+
+
+def consume_refresh_token(dbsess: Session, jti: str, family: str):
+    # subject of the token, None for an unknown, used or expired token.
+    # single use: concurrent requests may read the row, only one of them deletes it
+    subject = dbsess.execute(SELECT_REFRESH_TOKEN, {'jti': jti, 'family': family, 'now': int(time())}).scalar()
+    if subject is not None and dbsess.execute(CONSUME_REFRESH_TOKEN, {'jti': jti}).rowcount != 1:
+        subject = None
+    dbsess.commit()
+    return subject
+
+
+def delete_refresh_family(dbsess: Session, family: str):
+    dbsess.execute(DELETE_REFRESH_FAMILY, {'family': family})
+    dbsess.commit()
+
+
+def delete_refresh_tokens(dbsess: Session, subject: str):
+    dbsess.execute(DELETE_REFRESH_TOKENS, {'subject': subject})
+    dbsess.commit()
+
+
+async def async_create_refresh_token(dbsess, jti: str, family: str, subject: str, expiry: int):
+    await dbsess.execute(DELETE_EXPIRED_REFRESH_TOKENS, {'subject': subject, 'now': int(time())})
+    await dbsess.execute(INSERT_REFRESH_TOKEN, {'jti': jti, 'family': family, 'subject': subject, 'expiry': expiry})
+    await dbsess.commit()
+
+
+async def async_consume_refresh_token(dbsess, jti: str, family: str):
+    subject = (await dbsess.execute(SELECT_REFRESH_TOKEN, {'jti': jti, 'family': family, 'now': int(time())})).scalar()
+    if subject is not None and (await dbsess.execute(CONSUME_REFRESH_TOKEN, {'jti': jti})).rowcount != 1:
+        subject = None
+    await dbsess.commit()
+    return subject
+
+
+async def async_delete_refresh_family(dbsess, family: str):
+    await dbsess.execute(DELETE_REFRESH_FAMILY, {'family': family})
+    await dbsess.commit()
+
+
+async def async_delete_refresh_tokens(dbsess, subject: str):
+    await dbsess.execute(DELETE_REFRESH_TOKENS, {'subject': subject})
+    await dbsess.commit()
+
+
+def migrate(engine=Engine):
+    # idempotent schema migration: missing tables are created, missing columns added and, on mysql, string columns
+    # narrower than the model, and integer columns of a bigint in the model, widened. return the statements applied.
+    # the connections are released afterward, forked workers must not inherit them
+    applied = []
+    Base.metadata.create_all(bind=engine)
+    inspector = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = {column['name']: column['type'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                definition = CreateColumn(column).compile(dialect=engine.dialect)
+                if column.name not in existing:
+                    statement = f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {definition}'
+                elif engine.dialect.name == 'mysql' and getattr(column.type, 'length', None) and \
+                     (getattr(existing[column.name], 'length', None) or 0) < column.type.length:
+                    statement = f'ALTER TABLE {preparer.format_table(table)} MODIFY {definition}'
+                elif engine.dialect.name == 'mysql' and isinstance(column.type, BigInteger) and \
+                     not isinstance(existing[column.name], BigInteger):
+                    statement = f'ALTER TABLE {preparer.format_table(table)} MODIFY {definition}'
+                else:
+                    continue
+                connection.exec_driver_sql(statement)
+                applied.append(statement)
+                logger.info(kv(module='auth', space='database', action='migrate', statement=statement))
+    engine.dispose()
+    return applied
+
+
+def release(engine=Engine):
+    # close the pooled connections, a process forked afterward does not share their sockets.
+    # an in-memory sqlite database only lives in its single connection, it is kept
+    if isinstance(engine.pool, QueuePool):
+        engine.dispose()
+
+
+def warmup_size(engine):
+    pool = getattr(engine, 'sync_engine', engine).pool
+    return pool.size() if isinstance(pool, QueuePool) else 1
+
+
+def warmup(engine=Engine):
+    # open the connections of the pool ahead of the first requests, raise when the database is unreachable
+    connections = []
+    try:
+        for _ in range(warmup_size(engine)):
+            connections.append(engine.connect())
+            connections[-1].exec_driver_sql('SELECT 1')
+    finally:
+        for connection in connections:
+            connection.close()
 
 
-def delete_account(db: Session, account: AccountBase):
-    db.delete(account)
-    db.commit()
+async def async_warmup(engine=AsyncEngine):
+    connections = []
+    try:
+        for _ in range(warmup_size(engine)):
+            connections.append(await engine.connect())
+            await connections[-1].exec_driver_sql('SELECT 1')
+    finally:
+        for connection in connections:
+            await connection.close()
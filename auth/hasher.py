@@ -0,0 +1,91 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from config import HASHER_POOL, HASHER_WORKERS, HASHER_QUEUE_SIZE
+from utils import logger, kv
+from passwords import hash_password, verify_password
+from metrics import timed, HASHER_REJECTED
+
+
+class HasherBusy(Exception):
+    # raised when all hashing workers are busy and the waiting queue is full
+    pass
+
+
+def hashpw(plain_password):
+    # module level function so it can be pickled to the process pool
+    # hash of the configured password scheme, as string since the hash is stored as string in database
+    return hash_password(plain_password)
+
+
+def checkpw(plain_password, hashed_password):
+    return verify_password(plain_password, hashed_password)
+
+
+class HasherPool:
+    # dedicated executor for bcrypt, so password hashing never run on the shared api threadpool.
+    # admission control: at most (workers + queuesize) jobs are in flight, the next one is rejected
+    # right away, so a login storm degrade predictably instead of piling up requests behind bcrypt.
+    def __init__(self, pooltype=HASHER_POOL, workers=HASHER_WORKERS, queuesize=HASHER_QUEUE_SIZE):
+        self.pooltype = pooltype
+        self.workers = workers
+        self.capacity = workers + queuesize
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def executor(self):
+        # lazy creation, the workers are only spawned by the process that actually serve requests
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    if self.pooltype == 'PROCESS':
+                        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                    else:
+                        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='hasher')
+                    logger.info(kv(module='auth', space='hasher', action='start', pooltype=self.pooltype, workers=self.workers, capacity=self.capacity))
+        return self._executor
+
+    def submit(self, func, *args, wait=False):
+        # wait: block until a slot is free instead of rejecting, for the background jobs (bulk import)
+        if not self._slots.acquire(blocking=wait):
+            self.rejected += 1
+            HASHER_REJECTED.inc()
+            raise HasherBusy(f'hasher capacity {self.capacity} reached')
+        try:
+            future = self.executor().submit(func, *args)
+        except:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future):
+        self._slots.release()
+
+    def hash_password(self, plain_password):
+        with timed('bcrypt_hash'):
+            return self.submit(hashpw, plain_password).result()
+
+    def verify_password(self, plain_password, hashed_password):
+        with timed('bcrypt_verify'):
+            return self.submit(checkpw, plain_password, hashed_password).result()
+
+    async def async_hash_password(self, plain_password):
+        # the event loop is free while the worker hash, no api threadpool slot is held
+        with timed('bcrypt_hash'):
+            return await asyncio.wrap_future(self.submit(hashpw, plain_password))
+
+    async def async_verify_password(self, plain_password, hashed_password):
+        with timed('bcrypt_verify'):
+            return await asyncio.wrap_future(self.submit(checkpw, plain_password, hashed_password))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+hasher = HasherPool()
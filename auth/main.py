@@ -1,20 +1,47 @@
 #!/usr/bin/python3
 
+import os
+import glob
 import traceback
 import uvicorn
 
-from config import LISTEN_IPADDR, LISTEN_PORT, LOGLEVEL, API_WORKERS
-from utils import logger
+from config import LISTEN_IPADDR, LISTEN_PORT, LOGLEVEL, API_WORKERS, DB_POOL_SIZE, DB_MAX_OVERFLOW, METRICS, METRICS_DIR, PRELOAD, AUTO_MIGRATE
+from utils import logger, kv
 
 
 if __name__ == '__main__':
     try:
-        logger.info('module=auth, space=main, state=starting')
+        logger.info(kv(module='auth', space='main', state='starting'))
         # HTTP API
-        logger.debug(f'module=auth, space=main, action=report, httpapi={LISTEN_IPADDR}:{LISTEN_PORT}')
-        uvicorn.run('api:httpapi', host=LISTEN_IPADDR, port=LISTEN_PORT, workers=API_WORKERS, log_level=LOGLEVEL.lower(), access_log=False, )
+        logger.debug(kv(module='auth', space='main', action='report', httpapi=f'{LISTEN_IPADDR}:{LISTEN_PORT}'))
+        # upper bound of mysql connections opened by this instance
+        logger.info(kv(module='auth', space='main', action='report', workers=API_WORKERS, dbconnections_max=API_WORKERS * (DB_POOL_SIZE + DB_MAX_OVERFLOW)))
+        if METRICS and (API_WORKERS > 1 or PRELOAD):
+            # directory of the metrics files of the workers, must be set before they import prometheus_client,
+            # the supervisor may scale a single worker up. the files of a previous run are removed, only those:
+            # the directory comes from the environment and may hold anything else
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            for pattern in ['counter_*.db', 'gauge_*.db', 'histogram_*.db', 'summary_*.db']:
+                for path in glob.glob(os.path.join(METRICS_DIR, pattern)):
+                    os.remove(path)
+            os.environ['PROMETHEUS_MULTIPROC_DIR'] = METRICS_DIR
+        # imported here: metrics must not be imported before PROMETHEUS_MULTIPROC_DIR is set
+        from supervisor import Supervisor, GracefulServer, GracefulMultiprocess
+        if AUTO_MIGRATE:
+            # once, before the workers import the application: they only create the missing tables
+            from database import Engine, migrate
+            migrate(Engine)
+        config = uvicorn.Config('api:httpapi', host=LISTEN_IPADDR, port=LISTEN_PORT, workers=API_WORKERS, log_level=LOGLEVEL.lower(), access_log=False)
+        if PRELOAD:
+            # the workers are forked by the supervisor once the application is imported
+            Supervisor(config, API_WORKERS).run()
+        elif API_WORKERS > 1:
+            # each worker is a new interpreter which imports the application on its own
+            GracefulMultiprocess(config, target=GracefulServer(config).run, sockets=[config.bind_socket()]).run()
+        else:
+            GracefulServer(config).run()
     except Exception as e:
-        logger.error(f'module=auth, space=main, state=error, exception={e}, traceback={traceback.format_exc()}')
+        logger.error(kv(module='auth', space='main', state='error', exception=e, traceback=traceback.format_exc()))
     finally:
-        logger.critical('module=auth, space=main, state=termimated')
+        logger.critical(kv(module='auth', space='main', state='termimated'))
 
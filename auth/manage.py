@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+
+import io
+import sys
+import argparse
+import traceback
+
+from config import BULK_CHUNK_SIZE, PASSWORD_SCHEME
+from utils import logger, kv
+from database import SessionLocal, Engine, migrate
+from bulk import FORMATS, BulkImport, export_lines
+from hasher import hasher
+from passwords import calibrate
+
+
+def users_import(args):
+    # the file is read line by line, only one chunk of accounts is held in memory
+    # no login is served by this process, the import takes all the hasher workers
+    migrate(Engine)
+    dbsess = SessionLocal()
+    importer = BulkImport(dbsess, args.format, args.chunk_size, share=hasher.workers)
+    try:
+        with (io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='') if args.file == '-' else open(args.file, encoding='utf-8', newline='')) as infile:
+            stats = importer.feed(infile)
+        print(kv(**stats))
+    finally:
+        hasher.shutdown()
+        dbsess.close()
+
+
+def schema_migrate(args):
+    # run by the deployment before the workers are started, with AUTO_MIGRATE disabled
+    for statement in migrate(Engine):
+        print(statement)
+
+
+def users_export(args):
+    with (sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8', newline='')) as outfile:
+        for lines in export_lines(args.format, args.chunk_size):
+            outfile.write(lines)
+
+
+def password_calibrate(args):
+    # environment of the password policy for the target verify time on this host
+    scheme, elapsed = calibrate(args.scheme, args.target_ms / 1000)
+    print(f'PASSWORD_SCHEME={args.scheme}')
+    for name, value in scheme.env().items():
+        print(f'{name}={value}')
+    print(f'# verify time {round(elapsed * 1000, 1)}ms, target {args.target_ms}ms', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='auth management commands')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    migrateparser = subparsers.add_parser('migrate', help='create or upgrade the database schema')
+    migrateparser.set_defaults(func=schema_migrate)
+
+    importparser = subparsers.add_parser('import', help='bulk import of accounts from ndjson or csv')
+    importparser.add_argument('file', help='input file, - for stdin')
+    importparser.add_argument('--format', choices=FORMATS, default='ndjson')
+    importparser.add_argument('--chunk-size', type=int, default=BULK_CHUNK_SIZE)
+    importparser.set_defaults(func=users_import)
+
+    exportparser = subparsers.add_parser('export', help='export of accounts (email and password hash) as ndjson or csv')
+    exportparser.add_argument('--output', default='-', help='output file, - for stdout')
+    exportparser.add_argument('--format', choices=FORMATS, default='ndjson')
+    exportparser.add_argument('--chunk-size', type=int, default=BULK_CHUNK_SIZE)
+    exportparser.set_defaults(func=users_export)
+
+    calibrateparser = subparsers.add_parser('calibrate', help='password hashing cost for a target verify time on this host')
+    calibrateparser.add_argument('--scheme', choices=['BCRYPT', 'ARGON2ID', 'SCRYPT'], default=PASSWORD_SCHEME)
+    calibrateparser.add_argument('--target-ms', type=float, default=250)
+    calibrateparser.set_defaults(func=password_calibrate)
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    except Exception as e:
+        logger.error(kv(module='auth', space='manage', command=args.command, exception=e, traceback=traceback.format_exc()))
+        sys.exit(1)
@@ -0,0 +1,80 @@
+import os
+from time import perf_counter
+from contextlib import contextmanager
+
+from config import METRICS
+from utils import logger, kv
+
+
+# metrics are aggregated across api workers through the files of PROMETHEUS_MULTIPROC_DIR,
+# the directory is prepared by main.py before the workers are started
+MULTIPROCESS = 'PROMETHEUS_MULTIPROC_DIR' in os.environ
+
+ENABLED = False
+if METRICS:
+    try:
+        from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess, REGISTRY, CONTENT_TYPE_LATEST
+        ENABLED = True
+    except ImportError:
+        logger.warning(kv(module='auth', space='metrics', error='prometheus_client is not installed, metrics are disabled'))
+
+
+class NoopMetric:
+    # stand-in when metrics are disabled
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def observe(self, amount):
+        pass
+
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+STAGE_BUCKETS = (.0001, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+
+if ENABLED:
+    REQUESTS = Counter('auth_http_requests_total', 'http requests', ['handler', 'method', 'status'])
+    REQUEST_LATENCY = Histogram('auth_http_request_duration_seconds', 'http request latency', ['handler', 'method'], buckets=LATENCY_BUCKETS)
+    # bcrypt_hash, bcrypt_verify (including the hasher queue wait), db, jwt_encode, jwt_decode
+    STAGE_LATENCY = Histogram('auth_stage_duration_seconds', 'time spent per processing stage', ['stage'], buckets=STAGE_BUCKETS)
+    HASHER_REJECTED = Counter('auth_hasher_rejected_total', 'hashing jobs rejected by the hasher admission control')
+    RATELIMITED = Counter('auth_ratelimited_total', 'requests rejected by the rate limits', ['key'])
+    DBPOOL_WAIT = Histogram('auth_dbpool_checkout_wait_seconds', 'wait time for a database connection', buckets=STAGE_BUCKETS)
+    DBPOOL_INUSE = Gauge('auth_dbpool_connections_in_use', 'database connections checked out', multiprocess_mode='livesum')
+    DBPOOL_OVERFLOWS = Counter('auth_dbpool_overflow_total', 'database connections opened beyond the pool size')
+    DBPOOL_TIMEOUTS = Counter('auth_dbpool_timeout_total', 'database connection checkouts timed out')
+    # replica, primary (no replica, read-after-write, not found on the replica) and replica_error
+    ACCOUNT_READS = Counter('auth_db_account_reads_total', 'account lookups by database target', ['target'])
+else:
+    REQUESTS = REQUEST_LATENCY = STAGE_LATENCY = HASHER_REJECTED = RATELIMITED = NoopMetric()
+    DBPOOL_WAIT = DBPOOL_INUSE = DBPOOL_OVERFLOWS = DBPOOL_TIMEOUTS = ACCOUNT_READS = NoopMetric()
+
+
+@contextmanager
+def timed(stage):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(stage).observe(perf_counter() - start)
+
+
+def render():
+    # prometheus text exposition, the sum of all workers on multiprocess mode
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
+
+
+def process_dead(pid):
+    # live gauges of an exited worker are removed from the aggregation
+    if ENABLED and MULTIPROCESS:
+        multiprocess.mark_process_dead(pid)
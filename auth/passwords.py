@@ -0,0 +1,210 @@
+import hmac
+import base64
+import hashlib
+import secrets
+from time import perf_counter
+
+from config import PASSWORD_SCHEME, BCRYPT_ROUNDS, ARGON2_TIME_COST, ARGON2_MEMORY_COST, ARGON2_PARALLELISM, SCRYPT_LN, SCRYPT_R, SCRYPT_P
+from utils import logger, kv, get_hashed_password, verify_password as bcrypt_verify_password
+
+try:
+    import argon2
+except ImportError:
+    argon2 = None
+
+
+def b64encode(data):
+    return base64.b64encode(data).rstrip(b'=').decode()
+
+
+def b64decode(data):
+    return base64.b64decode(data + '=' * (-len(data) % 4))
+
+
+class BcryptScheme:
+    # $2b$<rounds>$<salt+hash>
+    name = 'BCRYPT'
+
+    def __init__(self, rounds=BCRYPT_ROUNDS):
+        self.rounds = rounds
+
+    def identify(self, hashed):
+        return hashed.startswith(('$2a$', '$2b$', '$2y$'))
+
+    def hash(self, plain_password):
+        return get_hashed_password(plain_password, self.rounds).decode()
+
+    def verify(self, plain_password, hashed_password):
+        return bcrypt_verify_password(plain_password, hashed_password)
+
+    def needs_rehash(self, hashed_password):
+        return int(hashed_password[4:6]) != self.rounds
+
+    def env(self):
+        return {'BCRYPT_ROUNDS': self.rounds}
+
+
+class Argon2Scheme:
+    # $argon2id$v=19$m=<memory>,t=<time>,p=<parallelism>$<salt>$<hash>
+    name = 'ARGON2ID'
+
+    def __init__(self, time_cost=ARGON2_TIME_COST, memory_cost=ARGON2_MEMORY_COST, parallelism=ARGON2_PARALLELISM):
+        self.params = {'time_cost': time_cost, 'memory_cost': memory_cost, 'parallelism': parallelism}
+        self._hasher = argon2.PasswordHasher(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism, type=argon2.Type.ID)
+
+    def identify(self, hashed):
+        return hashed.startswith('$argon2id$')
+
+    def hash(self, plain_password):
+        return self._hasher.hash(plain_password)
+
+    def verify(self, plain_password, hashed_password):
+        try:
+            return self._hasher.verify(hashed_password, plain_password)
+        except argon2.exceptions.VerificationError:
+            return False
+        except argon2.exceptions.InvalidHash:
+            return False
+
+    def needs_rehash(self, hashed_password):
+        return self._hasher.check_needs_rehash(hashed_password)
+
+    def env(self):
+        return {'ARGON2_TIME_COST': self.params['time_cost'], 'ARGON2_MEMORY_COST': self.params['memory_cost'], 'ARGON2_PARALLELISM': self.params['parallelism']}
+
+
+class ScryptScheme:
+    # $scrypt$ln=<log2 n>,r=<r>,p=<p>$<salt>$<hash>, built on hashlib, no extra dependency
+    name = 'SCRYPT'
+
+    def __init__(self, ln=SCRYPT_LN, r=SCRYPT_R, p=SCRYPT_P):
+        self.ln, self.r, self.p = ln, r, p
+
+    def identify(self, hashed):
+        return hashed.startswith('$scrypt$')
+
+    @staticmethod
+    def derive(plain_password, salt, ln, r, p):
+        n = 1 << ln
+        # memory required by scrypt is 128 * r * (n + p) bytes, the hashlib default limit is 32MiB
+        return hashlib.scrypt(plain_password.encode(), salt=salt, n=n, r=r, p=p, maxmem=128 * r * (n + p) + 1024 * 1024, dklen=32)
+
+    @staticmethod
+    def parse(hashed_password):
+        _, _, params, salt, digest = hashed_password.split('$')
+        params = dict(param.split('=') for param in params.split(','))
+        return int(params['ln']), int(params['r']), int(params['p']), b64decode(salt), b64decode(digest)
+
+    def hash(self, plain_password):
+        salt = secrets.token_bytes(16)
+        digest = self.derive(plain_password, salt, self.ln, self.r, self.p)
+        return f'$scrypt$ln={self.ln},r={self.r},p={self.p}${b64encode(salt)}${b64encode(digest)}'
+
+    def verify(self, plain_password, hashed_password):
+        try:
+            ln, r, p, salt, digest = self.parse(hashed_password)
+        except (ValueError, KeyError):
+            return False
+        return hmac.compare_digest(self.derive(plain_password, salt, ln, r, p), digest)
+
+    def needs_rehash(self, hashed_password):
+        return self.parse(hashed_password)[:3] != (self.ln, self.r, self.p)
+
+    def env(self):
+        return {'SCRYPT_LN': self.ln, 'SCRYPT_R': self.r, 'SCRYPT_P': self.p}
+
+
+class PasswordPolicy:
+    # new hashes are made by the configured scheme with its current parameters,
+    # existing hashes are verified by the scheme identified from their prefix.
+    # a hash of another scheme or other parameters needs rehash: it is replaced after the next successful login,
+    # so the cost can be tuned without forcing a password reset.
+    def __init__(self, scheme, schemes):
+        self.scheme = scheme
+        self.schemes = schemes
+
+    def identify(self, hashed_password):
+        for scheme in self.schemes:
+            if scheme.identify(hashed_password):
+                return scheme
+        return None
+
+    def hash(self, plain_password):
+        return self.scheme.hash(plain_password)
+
+    def verify(self, plain_password, hashed_password):
+        scheme = self.identify(hashed_password)
+        if scheme is None:
+            logger.error(kv(module='auth', space='passwords', error='unsupported password hash scheme', prefix=hashed_password[:10]))
+            return False
+        try:
+            return scheme.verify(plain_password, hashed_password)
+        except ValueError as e:
+            logger.error(kv(module='auth', space='passwords', error='malformed password hash', exception=e))
+            return False
+
+    def needs_rehash(self, hashed_password):
+        scheme = self.identify(hashed_password)
+        try:
+            return scheme is not self.scheme or scheme.needs_rehash(hashed_password)
+        except ValueError:
+            return True
+
+
+def build_policy(name=PASSWORD_SCHEME):
+    schemes = {'BCRYPT': BcryptScheme(), 'SCRYPT': ScryptScheme()}
+    if argon2 is not None:
+        schemes['ARGON2ID'] = Argon2Scheme()
+    elif name == 'ARGON2ID':
+        logger.warning(kv(module='auth', space='passwords', error='argon2-cffi is not installed, fallback to BCRYPT'))
+        name = 'BCRYPT'
+    return PasswordPolicy(schemes[name], list(schemes.values()))
+
+
+policy = build_policy()
+
+
+def hash_password(plain_password):
+    return policy.hash(plain_password)
+
+
+def verify_password(plain_password, hashed_password):
+    return policy.verify(plain_password, hashed_password)
+
+
+def needs_rehash(hashed_password):
+    return policy.needs_rehash(hashed_password)
+
+
+def verify_time(scheme, repeat=3):
+    # median verify time of the scheme on this host, in second
+    hashed_password = scheme.hash('P@ssw0rdOK')
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        scheme.verify('P@ssw0rdOK', hashed_password)
+        timings.append(perf_counter() - start)
+    return sorted(timings)[repeat // 2]
+
+
+def calibrate(name, target):
+    # highest cost of the scheme whose verify time stays within target (in second), the other parameters are kept,
+    # return the scheme and its verify time, the lowest cost when even it is above the target
+    if name == 'BCRYPT':
+        candidates = (BcryptScheme(rounds) for rounds in range(4, 32))
+    elif name == 'SCRYPT':
+        candidates = (ScryptScheme(ln, SCRYPT_R, SCRYPT_P) for ln in range(10, 23))
+    else:
+        if argon2 is None:
+            raise RuntimeError('argon2-cffi is not installed')
+        candidates = (Argon2Scheme(time_cost, ARGON2_MEMORY_COST, ARGON2_PARALLELISM) for time_cost in range(1, 101))
+
+    best, best_time = None, None
+    for scheme in candidates:
+        elapsed = verify_time(scheme)
+        if elapsed > target and best is not None:
+            break
+        best, best_time = scheme, elapsed
+        if elapsed > target:
+            break
+    return best, best_time
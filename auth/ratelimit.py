@@ -0,0 +1,225 @@
+import os
+import json
+import errno
+import math
+import mmap
+import fcntl
+import struct
+import hashlib
+import threading
+from time import time
+
+from config import RATELIMIT_WINDOW, RATELIMIT_IP, RATELIMIT_EMAIL, RATELIMIT_BACKEND, RATELIMIT_MAX_KEYS, RATELIMIT_SHARED_FILE
+from metrics import RATELIMITED
+
+
+# endpoints running bcrypt on behalf of an anonymous client
+RATELIMIT_PATHS = ['/auth/login', '/auth/register']
+
+# body of the limited endpoints is a small json document, anything bigger is rejected before being buffered
+MAX_BODY_SIZE = 64 * 1024
+
+
+def slide(index, prev, curr, now, window):
+    # roll the two counters of the sliding window to the window of now
+    current = int(now // window)
+    if index == current:
+        return current, prev, curr
+    if index == current - 1:
+        return current, curr, 0
+    return current, 0, 0
+
+
+def estimate(prev, curr, now, window):
+    # requests of the last window: the previous window weighted by its overlap, plus the current window
+    return prev * (1 - (now % window) / window) + curr
+
+
+class LocalCounters:
+    # sliding window counters of the worker: key -> (window index, previous count, current count), 3 integers per key.
+    # keys without hit in the last two windows are swept once per window, the least recently hit key is
+    # dropped when maxkeys is reached, so a flood of distinct ips can not grow the memory.
+    def __init__(self, window=RATELIMIT_WINDOW, maxkeys=RATELIMIT_MAX_KEYS):
+        self.window = window
+        self.maxkeys = maxkeys
+        self._counters = {}
+        self._swept = 0
+        self._lock = threading.Lock()
+
+    def hit(self, key, limit, now):
+        with self._lock:
+            index, prev, curr = slide(*self._counters.pop(key, (0, 0, 0)), now, self.window)
+            allowed = estimate(prev, curr, now, self.window) < limit
+            if allowed:
+                curr += 1
+            # re-inserted at the end, the dict order is the recency order
+            self._counters[key] = (index, prev, curr)
+            if index != self._swept:
+                self._counters = {key: counter for key, counter in self._counters.items() if counter[0] >= index - 1}
+                self._swept = index
+            while len(self._counters) > self.maxkeys:
+                del self._counters[next(iter(self._counters))]
+            return allowed
+
+
+# slot of the shared counters: key digest, window index, previous count, current count
+SLOT = struct.Struct('=QIII')
+# slots of a bucket, a key may take any slot of the bucket of its digest
+WAYS = 4
+# secret of the digest, in the header of the shared file
+KEY_SIZE = 16
+# non-blocking attempts on the lock of a bucket before the hit falls back to the counters of the worker
+LOCK_ATTEMPTS = 3
+
+class SharedCounters:
+    # sliding window counters in a memory mapped file, shared by the api workers of the host.
+    # fixed number of buckets of WAYS slots, the memory is bounded by construction. the digest is keyed by a random
+    # secret created with the file, so a client can not compute which keys share a bucket. a key takes a free or
+    # expired slot of its bucket, a bucket full of live counters counts the key against the busiest one: a collision
+    # never resets a counter, it fails closed. an update only locks the byte range of its bucket, it runs on the event
+    # loop so the lock is never waited for: a bucket held by another worker counts the hit in the counters of this
+    # worker instead, the limit then applies per worker until the bucket is free again.
+    def __init__(self, window=RATELIMIT_WINDOW, slots=RATELIMIT_MAX_KEYS, path=RATELIMIT_SHARED_FILE):
+        self.window = window
+        self.buckets = max(slots // WAYS, 1)
+        self.path = path
+        self.contended = 0
+        self._fallback = LocalCounters(window, slots)
+        self._pid = None
+        self._fd = None
+        self._mmap = None
+        self._key = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        # mapped by each worker on first use, after the fork
+        if self._pid != os.getpid():
+            size = KEY_SIZE + self.buckets * WAYS * SLOT.size
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            buffer = mmap.mmap(fd, size)
+            # the first process mapping the file creates the secret, the others read it
+            fcntl.lockf(fd, fcntl.LOCK_EX, KEY_SIZE, 0)
+            try:
+                if buffer[:KEY_SIZE] == bytes(KEY_SIZE):
+                    buffer[:KEY_SIZE] = os.urandom(KEY_SIZE)
+                key = bytes(buffer[:KEY_SIZE])
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, KEY_SIZE, 0)
+            self._fd, self._mmap, self._key, self._pid = fd, buffer, key, os.getpid()
+        return self._mmap
+
+    def trylock(self, offset):
+        for _ in range(LOCK_ATTEMPTS):
+            try:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, WAYS * SLOT.size, offset)
+                return True
+            except OSError as e:
+                if e.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+        return False
+
+    def hit(self, key, limit, now):
+        # fcntl lock exclude the other workers, the thread lock the other threads of this worker.
+        # the bucket is held for a read and a write of WAYS slots, no io nor allocation of the file
+        with self._lock:
+            buffer = self.open()
+            digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8, key=self._key).digest(), 'little')
+            offset = KEY_SIZE + (digest % self.buckets) * WAYS * SLOT.size
+            if not self.trylock(offset):
+                self.contended += 1
+                return self._fallback.hit(key, limit, now)
+            try:
+                ways = []
+                for position in range(offset, offset + WAYS * SLOT.size, SLOT.size):
+                    owner, index, prev, curr = SLOT.unpack_from(buffer, position)
+                    ways.append((position, owner, *slide(index, prev, curr, now, self.window)))
+                owned = [way for way in ways if way[1] == digest]
+                free = [way for way in ways if way[3] == 0 and way[4] == 0]
+                if owned:
+                    position, owner, index, prev, curr = owned[0]
+                elif free:
+                    position, _, index, prev, curr = free[0]
+                    owner = digest
+                else:
+                    position, owner, index, prev, curr = max(ways, key=lambda way: estimate(way[3], way[4], now, self.window))
+                allowed = estimate(prev, curr, now, self.window) < limit
+                if allowed:
+                    curr += 1
+                SLOT.pack_into(buffer, position, owner, index, prev, curr)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, WAYS * SLOT.size, offset)
+        return allowed
+
+
+def extract_email(body):
+    try:
+        email = json.loads(body).get('email')
+    except (ValueError, AttributeError):
+        return None
+    return email.strip().lower() if isinstance(email, str) else None
+
+
+class RateLimitMiddleware:
+    # pure asgi middleware in front of the application: the client ip is checked before the body is read,
+    # the email once the small body is buffered, which is then replayed to the application.
+    # a rejected request never reaches the body validation, the database nor the hasher.
+    def __init__(self, app, counters=None, iplimit=RATELIMIT_IP, emaillimit=RATELIMIT_EMAIL, paths=RATELIMIT_PATHS):
+        self.app = app
+        if counters is None:
+            counters = SharedCounters() if RATELIMIT_BACKEND == 'SHARED' else LocalCounters()
+        self.counters = counters
+        self.iplimit = iplimit
+        self.emaillimit = emaillimit
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'POST' or scope['path'] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        now = time()
+        client = scope.get('client')
+        if client and not self.counters.hit(f'ip:{client[0]}', self.iplimit, now):
+            await self.reject(send, 'ip', 429, now)
+            return
+
+        chunks, size, more_body = [], 0, True
+        while more_body:
+            message = await receive()
+            if message['type'] != 'http.request':
+                return
+            chunks.append(message.get('body', b''))
+            size += len(chunks[-1])
+            if size > MAX_BODY_SIZE:
+                await self.reject(send, 'size', 413, now)
+                return
+            more_body = message.get('more_body', False)
+        body = b''.join(chunks)
+
+        email = extract_email(body)
+        if email and not self.counters.hit(f'email:{email}', self.emaillimit, now):
+            await self.reject(send, 'email', 429, now)
+            return
+
+        replayed = False
+        async def replay():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            return await receive()
+
+        await self.app(scope, replay, send)
+
+    async def reject(self, send, key, status, now):
+        RATELIMITED.labels(key).inc()
+        window = self.counters.window
+        content = b'{"status":"failed","detail":"too many requests"}' if status == 429 else b'{"status":"failed","detail":"request too large"}'
+        headers = [(b'content-type', b'application/json'), (b'content-length', str(len(content)).encode())]
+        if status == 429:
+            # end of the current window, the counters are rolled over by then
+            headers.append((b'retry-after', str(math.ceil(window - now % window)).encode()))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': content})
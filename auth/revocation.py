@@ -0,0 +1,130 @@
+import os
+import threading
+import traceback
+from time import time, sleep
+
+from config import REVOCATION_BACKEND, REVOCATION_SYNC_INTERVAL, DEFAULT_TOKEN_EXPIRY
+from utils import logger, kv
+from database import SessionLocal, create_revocation, get_revocations, delete_revocations, invalidate_account
+
+
+class LocalBackend:
+    # in-process stand-in of the shared backend, for test or single worker deployment
+    def __init__(self):
+        self._entries = []
+        self._lock = threading.Lock()
+
+    def publish(self, subject, notbefore, expiry):
+        with self._lock:
+            self._entries.append((subject, notbefore, expiry))
+
+    def fetch(self, since, now):
+        with self._lock:
+            return [entry for entry in self._entries if entry[1] >= since and entry[2] > now]
+
+    def prune(self, now):
+        with self._lock:
+            self._entries = [entry for entry in self._entries if entry[2] > now]
+
+
+class DatabaseBackend:
+    # revocations shared by all api workers through the revocations table,
+    # each worker polls it periodically, never on the request path
+    def publish(self, subject, notbefore, expiry):
+        dbsess = SessionLocal()
+        try:
+            create_revocation(dbsess, subject, notbefore, expiry)
+        finally:
+            dbsess.close()
+
+    def fetch(self, since, now):
+        dbsess = SessionLocal()
+        try:
+            return get_revocations(dbsess, since, now)
+        finally:
+            dbsess.close()
+
+    def prune(self, now):
+        dbsess = SessionLocal()
+        try:
+            delete_revocations(dbsess, now)
+        finally:
+            dbsess.close()
+
+
+class RevocationList:
+    # in-memory index of per-user not-before timestamps: subject -> (notbefore, expiry)
+    # a token is revoked when it was issued (iat_ms) at or before the notbefore of its subject, both in millisecond.
+    # a token without iat_ms is taken as issued at the start of its iat second.
+    # the entry expires (in second) once every token it covers is expired, so the index only holds live revocations.
+    def __init__(self, backend, interval=REVOCATION_SYNC_INTERVAL, lifetime=DEFAULT_TOKEN_EXPIRY):
+        self.backend = backend
+        self.interval = interval
+        self.lifetime = lifetime
+        self._notbefore = {}
+        self._lock = threading.Lock()
+        self._synced = 0
+        self._thread = None
+        self._pid = None
+
+    def revoke(self, subject):
+        now = time()
+        notbefore = int(now * 1000)
+        expiry = int(now) + self.lifetime + 1
+        self._apply(subject, notbefore, expiry)
+        self.backend.publish(subject, notbefore, expiry)
+
+    def is_revoked(self, payload):
+        entry = self._notbefore.get(payload.get('email'))
+        if entry is None:
+            return False
+        return payload.get('iat_ms', payload.get('iat', 0) * 1000) <= entry[0]
+
+    def known(self, subject):
+        # a live revocation of the subject: its password was changed or the account deleted within the token lifetime
+        return subject in self._notbefore
+
+    def _apply(self, subject, notbefore, expiry):
+        with self._lock:
+            entry = self._notbefore.get(subject)
+            updated = entry is None or entry[0] < notbefore
+            if updated:
+                self._notbefore[subject] = (notbefore, expiry)
+        if updated:
+            # a revocation follows every password change and account deletion, the account cached by this worker is outdated
+            invalidate_account(subject)
+
+    def sync(self):
+        now = int(time())
+        # overlap the previous window, a revocation committed late by another worker is not missed
+        since = (self._synced - 2 * self.interval) * 1000 if self._synced else 0
+        for subject, notbefore, expiry in self.backend.fetch(since, now):
+            self._apply(subject, notbefore, expiry)
+        with self._lock:
+            self._notbefore = {subject: entry for subject, entry in self._notbefore.items() if entry[1] > now}
+        self.backend.prune(now)
+        self._synced = now
+
+    def start(self):
+        # background synchronization, started by the application startup of each worker:
+        # a thread of the process it was forked from does not run in a worker
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._thread = threading.Thread(target=self._run, name='revocation', daemon=True)
+                    self._thread.start()
+                    self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error(kv(module='auth', space='revocation', action='sync', exception=e, traceback=traceback.format_exc()))
+            sleep(self.interval)
+
+
+if REVOCATION_BACKEND == 'DATABASE':
+    revocations = RevocationList(DatabaseBackend())
+else:
+    revocations = RevocationList(LocalBackend())
@@ -1,8 +1,9 @@
-from pydantic import BaseModel, Field, root_validator, validator
-from typing import Optional
+from pydantic import BaseModel, Field, root_validator, validator, conlist
+from typing import Optional, List
 from enum import Enum
 
-from utils import check_email_format, check_password_format
+from config import INTROSPECT_MAX_BATCH
+from validation import EMAIL_MAX_LENGTH, check_email_format, check_password_format
 
 
 class ResultEnum(str, Enum):
@@ -10,6 +11,11 @@ class ResultEnum(str, Enum):
     failed = 'failed'
 
 
+class BulkFormatEnum(str, Enum):
+    ndjson = 'ndjson'
+    csv = 'csv'
+
+
 class GeneralRespModel(BaseModel):
     status: Optional[ResultEnum] = Field(description='result of request')
     detail: Optional[str] = Field(description='detail error description')
@@ -17,6 +23,48 @@ class GeneralRespModel(BaseModel):
 
 class TokenRespModel(GeneralRespModel):
     token: str = Field(description='session token')
+    refresh_token: Optional[str] = Field(description='single use token to renew the session token on /auth/refresh')
+
+
+class RefreshTokenModel(BaseModel):
+    refresh_token: str = Field(description='refresh token')
+
+
+class TokenClaims(BaseModel):
+    # verified claims of the session token, given to the handlers by JWTBearer
+    email: str
+    iat: int
+    exp: int
+    uid: Optional[int]
+    roles: List[str] = []
+    ver: Optional[int]
+
+    class Config:
+        # claims of custom enrichers are kept as extra attributes
+        extra = 'allow'
+
+    def has_role(self, role):
+        return role in self.roles
+
+
+class IntrospectModel(BaseModel):
+    tokens: conlist(str, min_items=1, max_items=INTROSPECT_MAX_BATCH) = Field(description='bearer tokens to verify')
+
+
+class TokenVerdictModel(BaseModel):
+    active: bool = Field(description='token is accepted as bearer token')
+    detail: Optional[str] = Field(description='reason of rejection')
+    claims: Optional[dict] = Field(description='claims of the active token')
+
+
+class IntrospectRespModel(BaseModel):
+    results: List[TokenVerdictModel] = Field(description='one verdict per token, in the request order')
+
+
+class BulkImportRespModel(GeneralRespModel):
+    imported: Optional[int] = Field(description='number of created accounts')
+    existing: Optional[int] = Field(description='number of skipped accounts, the email already exists')
+    invalid: Optional[int] = Field(description='number of rejected records, malformed or invalid email/password')
 
 
 def validate_email(email):
@@ -32,7 +80,7 @@ def validate_password(password):
 
 
 class UserModel(BaseModel):
-    email: str = Field('email address of user', max_length=254)
+    email: str = Field('email address of user', max_length=EMAIL_MAX_LENGTH)
     password: str = Field('password of user', max_length=32, min_length=8)
     # validate inputs
     # not validate the password since password policy format could changed.
@@ -45,7 +93,7 @@ class NewUserModel(UserModel):
 
 
 class UserChangePasswordModel(BaseModel):
-    email: str = Field('email address of user', max_length=254)
+    email: str = Field('email address of user', max_length=EMAIL_MAX_LENGTH)
     current_password: str = Field('current password of user', max_length=32, min_length=8)
     new_password: str = Field('current password of user', max_length=32, min_length=8)
     # validate inputs
@@ -0,0 +1,159 @@
+import os
+import json
+import base64
+import hashlib
+
+import jwt
+from jwt.algorithms import Algorithm
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
+    from cryptography.hazmat.primitives.serialization import load_pem_private_key, load_pem_public_key, Encoding, PublicFormat
+    CRYPTOGRAPHY = True
+except ImportError:
+    CRYPTOGRAPHY = False
+
+
+ASYMMETRIC_ALGORITHMS = ['RS256', 'ES256', 'EdDSA']
+
+
+if CRYPTOGRAPHY:
+    class Ed25519Algorithm(Algorithm):
+        # EdDSA for the PyJWT releases without native support
+        def prepare_key(self, key):
+            if isinstance(key, (ed25519.Ed25519PrivateKey, ed25519.Ed25519PublicKey)):
+                return key
+            raise jwt.InvalidKeyError('expecting an Ed25519 key')
+
+        def sign(self, msg, key):
+            return key.sign(msg)
+
+        def verify(self, msg, key, sig):
+            if isinstance(key, ed25519.Ed25519PrivateKey):
+                key = key.public_key()
+            try:
+                key.verify(sig, msg)
+                return True
+            except InvalidSignature:
+                return False
+
+    if 'EdDSA' not in jwt.algorithms.get_default_algorithms():
+        jwt.register_algorithm('EdDSA', Ed25519Algorithm())
+
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def b64url_uint(number):
+    return b64url(number.to_bytes((number.bit_length() + 7) // 8 or 1, 'big'))
+
+
+def check_key(algorithm, key):
+    # the key type must match the algorithm, a token can not be verified with another algorithm family
+    if algorithm == 'RS256':
+        if not isinstance(key, (rsa.RSAPrivateKey, rsa.RSAPublicKey)) or key.key_size < 2048:
+            raise ValueError('RS256 requires a RSA key of 2048 bits at least')
+    elif algorithm == 'ES256':
+        if not isinstance(key, (ec.EllipticCurvePrivateKey, ec.EllipticCurvePublicKey)) or key.curve.name != 'secp256r1':
+            raise ValueError('ES256 requires an EC P-256 key')
+    elif algorithm == 'EdDSA':
+        if not isinstance(key, (ed25519.Ed25519PrivateKey, ed25519.Ed25519PublicKey)):
+            raise ValueError('EdDSA requires an Ed25519 key')
+    else:
+        raise ValueError(f'unsupported algorithm {algorithm}')
+
+
+def public_jwk(algorithm, kid, public):
+    # RFC 7517/7518/8037 public key representation
+    jwk = {'kid': kid, 'use': 'sig', 'alg': algorithm}
+    if algorithm == 'RS256':
+        numbers = public.public_numbers()
+        jwk.update(kty='RSA', n=b64url_uint(numbers.n), e=b64url_uint(numbers.e))
+    elif algorithm == 'ES256':
+        numbers = public.public_numbers()
+        jwk.update(kty='EC', crv='P-256', x=b64url(numbers.x.to_bytes(32, 'big')), y=b64url(numbers.y.to_bytes(32, 'big')))
+    else:
+        jwk.update(kty='OKP', crv='Ed25519', x=b64url(public.public_bytes(Encoding.Raw, PublicFormat.Raw)))
+    return jwk
+
+
+class KeyRing:
+    # asymmetric signing keys indexed by kid. tokens are signed by a single key and carry its kid in the header,
+    # every key of the ring is accepted on verification and published on jwks, so a key can be rotated:
+    # publish the new key, switch the signing kid, keep the retired public key until its tokens are expired.
+    def __init__(self, algorithm):
+        if not CRYPTOGRAPHY:
+            raise RuntimeError('cryptography is not installed, required by asymmetric algorithm')
+        if algorithm not in ASYMMETRIC_ALGORITHMS:
+            raise ValueError(f'unsupported algorithm {algorithm}')
+        self.algorithm = algorithm
+        self.signing_kid = None
+        self._private = None
+        self._public = {}
+
+    def add(self, kid, pem):
+        # pem of a private key (signing candidate) or a public key (verification only)
+        try:
+            key = load_pem_private_key(pem, password=None)
+        except ValueError:
+            key = load_pem_public_key(pem)
+        return self.add_key(kid, key)
+
+    def add_key(self, kid, key):
+        # returns the key when it is a private key, None otherwise
+        check_key(self.algorithm, key)
+        if hasattr(key, 'public_key'):
+            self._public[kid] = key.public_key()
+            return key
+        self._public[kid] = key
+        return None
+
+    def use(self, kid, private):
+        self.signing_kid = kid
+        self._private = private
+
+    @classmethod
+    def load(cls, algorithm, directory, signing_kid=None):
+        # one key per file <kid>.pem, the signing key is signing_kid or the most recently modified private key
+        keyring = cls(algorithm)
+        filenames = [filename for filename in os.listdir(directory) if filename.endswith('.pem')]
+        filenames.sort(key=lambda filename: os.path.getmtime(os.path.join(directory, filename)))
+        privates = {}
+        for filename in filenames:
+            kid = filename[:-len('.pem')]
+            with open(os.path.join(directory, filename), 'rb') as pemfile:
+                private = keyring.add(kid, pemfile.read())
+            if private is not None:
+                privates[kid] = private
+        if signing_kid is None and privates:
+            signing_kid = list(privates)[-1]
+        if signing_kid not in privates:
+            raise ValueError(f'no private key for kid {signing_kid} in {directory}')
+        keyring.use(signing_kid, privates[signing_kid])
+        return keyring
+
+    def sign(self, payload):
+        return jwt.encode(payload, self._private, algorithm=self.algorithm, headers={'kid': self.signing_kid})
+
+    def verify(self, token):
+        # the key is selected by kid and the algorithm is pinned, the token header can not pick them
+        kid = jwt.get_unverified_header(token).get('kid')
+        public = self._public.get(kid)
+        if public is None:
+            raise jwt.InvalidTokenError(f'unknown kid {kid}')
+        return jwt.decode(token, public, algorithms=[self.algorithm])
+
+    def kids(self):
+        return list(self._public)
+
+    def jwks(self):
+        return {'keys': [public_jwk(self.algorithm, kid, public) for kid, public in self._public.items()]}
+
+
+def jwks_document(keyring):
+    # serialized once, the document only changes on restart. no key is published for HS256, the secret is shared
+    body = json.dumps(keyring.jwks() if keyring else {'keys': []}, separators=(',', ':')).encode()
+    etag = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+    return body, etag
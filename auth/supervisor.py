@@ -0,0 +1,255 @@
+import os
+import errno
+import asyncio
+import random
+import select
+import signal
+import socket
+import traceback
+import uvicorn
+from uvicorn.supervisors import Multiprocess
+from time import monotonic
+
+from config import REUSEPORT, WORKER_MAX_REQUESTS, WORKER_MAX_MEMORY, SHUTDOWN_GRACE
+from utils import logger, kv, flush_logs
+from database import Engine, release
+import metrics
+
+
+# period of the workers memory check, a signal wakes the supervisor up earlier
+CHECK_INTERVAL = 1.0
+
+# a worker exiting sooner after its start is failing: the next spawn is delayed, doubled up to BACKOFF_MAX
+MIN_UPTIME = 5.0
+BACKOFF_MIN = 0.5
+BACKOFF_MAX = 30.0
+
+PAGESIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def rss(pid):
+    # resident memory of the process in byte, 0 when unknown (no procfs)
+    try:
+        with open(f'/proc/{pid}/statm') as statm:
+            return int(statm.read().split()[1]) * PAGESIZE
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class GracefulServer(uvicorn.Server):
+    # SIGTERM: the worker fails its readiness probe first and keeps serving during the grace period, the time for
+    # the load balancer to stop routing to it, then uvicorn stops accepting and drains the connections.
+    # SIGINT or a second signal stops at once
+    def __init__(self, config, grace=SHUTDOWN_GRACE):
+        super().__init__(config=config)
+        self.grace = grace
+        self.draining = False
+
+    def handle_exit(self, sig, frame):
+        if sig == signal.SIGTERM and self.grace and not self.draining and not self.should_exit:
+            self.draining = True
+            # the application is loaded before the signal handlers are installed
+            from api import stopping
+            stopping()
+            asyncio.get_event_loop().call_later(self.grace, self.drain)
+        else:
+            super().handle_exit(sig, frame)
+
+    def drain(self):
+        self.should_exit = True
+
+
+class GracefulMultiprocess(Multiprocess):
+    # uvicorn stops its worker processes with SIGINT, the signal received is forwarded as is instead:
+    # on SIGTERM the workers get their grace period. the workers are joined by shutdown
+    def signal_handler(self, sig, frame):
+        for process in self.processes:
+            try:
+                os.kill(process.pid, sig)
+            except ProcessLookupError:
+                pass
+        self.should_exit.set()
+
+
+class Supervisor:
+    # preload mode: the application is imported once by this process, then the workers are forked.
+    # they share the imported modules, compiled statements and keys copy-on-write, and start serving
+    # without importing nor migrating again.
+    # the supervisor keeps the number of workers: a worker exiting (crash, max requests) is replaced,
+    # a worker above the memory ceiling is stopped gracefully then replaced, SIGTTIN adds and SIGTTOU removes one.
+    # workers failing right after their start are respawned with an exponential backoff.
+    # with reuseport, each worker listen on its own socket and the kernel spreads the connections,
+    # otherwise the workers accept from the socket shared by the supervisor.
+    def __init__(self, config, workers, reuseport=REUSEPORT, maxrequests=WORKER_MAX_REQUESTS, maxmemory=WORKER_MAX_MEMORY):
+        self.config = config
+        self.workers = workers
+        self.reuseport = reuseport and hasattr(socket, 'SO_REUSEPORT')
+        self.maxrequests = maxrequests
+        self.maxmemory = maxmemory * 1024 * 1024
+        self.pids = set()
+        # workers asked to stop, still serving their in-flight requests
+        self.retiring = set()
+        # start time of the workers, consecutive early exits, and no spawn before holdoff
+        self.started = {}
+        self.failures = 0
+        self.holdoff = 0.0
+        self.signals = []
+        self.should_exit = False
+        self.sock = None
+        if reuseport and not self.reuseport:
+            logger.warning(kv(module='auth', space='supervisor', error='SO_REUSEPORT is not supported, the workers share one socket'))
+
+    def bind(self):
+        host, port = self.config.host, self.config.port
+        sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))
+        return sock
+
+    def run(self):
+        self.config.load()
+        if self.reuseport:
+            # fail fast when the address is not available, the workers bind their own socket
+            self.bind().close()
+        else:
+            self.sock = self.config.bind_socket()
+
+        # the signal handlers only queue the signal, the wakeup fd interrupts the wait of the loop
+        self.pipe = os.pipe()
+        for fd in self.pipe:
+            os.set_blocking(fd, False)
+        signal.set_wakeup_fd(self.pipe[1])
+        for sig in [signal.SIGINT, signal.SIGTERM, signal.SIGTTIN, signal.SIGTTOU, signal.SIGCHLD]:
+            signal.signal(sig, self.handle_signal)
+
+        self.scale()
+        logger.info(kv(module='auth', space='supervisor', action='started', workers=self.workers, reuseport=self.reuseport, pids=sorted(self.pids)))
+        while self.pids or not self.should_exit:
+            self.wait()
+            while self.signals:
+                self.dispatch(self.signals.pop(0))
+            self.reap()
+            if not self.should_exit:
+                self.check_memory()
+                self.scale()
+        if self.sock:
+            self.sock.close()
+        logger.info(kv(module='auth', space='supervisor', action='stopped'))
+
+    def wait(self):
+        try:
+            select.select([self.pipe[0]], [], [], CHECK_INTERVAL)
+            while os.read(self.pipe[0], 64):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+    def handle_signal(self, sig, frame):
+        if sig != signal.SIGCHLD:
+            self.signals.append(sig)
+
+    def dispatch(self, sig):
+        if sig in (signal.SIGINT, signal.SIGTERM):
+            # graceful stop: the workers finish their in-flight requests
+            self.should_exit = True
+            for pid in self.pids:
+                self.kill(pid)
+        elif sig == signal.SIGTTIN:
+            self.workers += 1
+            logger.info(kv(module='auth', space='supervisor', action='scale', workers=self.workers))
+        elif sig == signal.SIGTTOU and self.workers > 1:
+            self.workers -= 1
+            logger.info(kv(module='auth', space='supervisor', action='scale', workers=self.workers))
+
+    def reap(self):
+        while self.pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.pids.clear()
+                return
+            if pid == 0:
+                return
+            self.pids.discard(pid)
+            metrics.process_dead(pid)
+            exitcode = os.waitstatus_to_exitcode(status)
+            uptime = monotonic() - self.started.pop(pid, 0.0)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                continue
+            if uptime < MIN_UPTIME:
+                self.failures += 1
+                backoff = min(BACKOFF_MIN * 2 ** (self.failures - 1), BACKOFF_MAX)
+                self.holdoff = monotonic() + backoff
+                logger.error(kv(module='auth', space='supervisor', action='exited', pid=pid, exitcode=exitcode, uptime=round(uptime, 3), backoff=backoff))
+            elif exitcode == 0:
+                # exit without being asked: the worker reached its max requests
+                logger.info(kv(module='auth', space='supervisor', action='exited', pid=pid, exitcode=exitcode))
+                self.failures = 0
+            else:
+                logger.warning(kv(module='auth', space='supervisor', action='exited', pid=pid, exitcode=exitcode))
+                self.failures = 0
+
+    def scale(self):
+        active = self.pids - self.retiring
+        if monotonic() >= self.holdoff:
+            for _ in range(self.workers - len(active)):
+                self.spawn()
+        for pid in sorted(active)[:max(len(active) - self.workers, 0)]:
+            self.kill(pid)
+
+    def check_memory(self):
+        if not self.maxmemory:
+            return
+        for pid in self.pids - self.retiring:
+            used = rss(pid)
+            if used > self.maxmemory:
+                # replaced by scale as soon as it is retiring, the old one drains meanwhile
+                logger.warning(kv(module='auth', space='supervisor', action='restart', pid=pid, rss=used))
+                self.kill(pid)
+
+    def kill(self, pid):
+        self.retiring.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            self.serve()
+        self.pids.add(pid)
+        self.started[pid] = monotonic()
+
+    def serve(self):
+        # worker: never returns into the supervisor code, whatever happen. the logs are flushed,
+        # then os._exit skips the exit handlers inherited from the supervisor
+        exitcode = 1
+        try:
+            # uvicorn installs its own SIGINT/SIGTERM handlers, until then the default ones
+            signal.set_wakeup_fd(-1)
+            for sig in [signal.SIGINT, signal.SIGTERM, signal.SIGTTIN, signal.SIGTTOU, signal.SIGCHLD]:
+                signal.signal(sig, signal.SIG_DFL)
+            for fd in self.pipe:
+                os.close(fd)
+            self.pids, self.retiring = set(), set()
+            # the pool inherited from the supervisor is replaced, the worker opens its own connections
+            release(Engine)
+            if self.maxrequests:
+                # jitter, the workers started together do not restart together
+                self.config.limit_max_requests = self.maxrequests + random.randint(0, self.maxrequests // 10)
+            sock = self.bind() if self.reuseport else self.sock
+            GracefulServer(self.config).run(sockets=[sock])
+            exitcode = 0
+        except SystemExit as e:
+            exitcode = e.code if isinstance(e.code, int) else 1
+        except BaseException as e:
+            logger.error(kv(module='auth', space='supervisor', action='worker', pid=os.getpid(), exception=e, traceback=traceback.format_exc()))
+        finally:
+            try:
+                flush_logs()
+            finally:
+                os._exit(exitcode)
@@ -1,7 +1,33 @@
+import os
+import re
+import fcntl
+import time
 import random
+import queue
+import logging
+import threading
+import pytest
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.orm import Session
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+import database
+from database import SessionLocal, Base, AccountBase, ReplicaSet, migrate, AccountRecord
+import claims
+from schemas import TokenClaims
+import supervisor as supervisor_module
+from supervisor import Supervisor, rss
 from config import DEFAULT_TOKEN_EXPIRY
-from utils import get_hashed_password, verify_password, generate_jwt_token, validate_jwt_token
+from utils import logger, kv, debug_sampled, NonBlockingQueueHandler, get_hashed_password, verify_password, generate_jwt_token, validate_jwt_token, validate_jwt_token_cached
+from hasher import HasherPool, HasherBusy
+import bulk
+import passwords
+from passwords import PasswordPolicy, BcryptScheme, ScryptScheme, Argon2Scheme
+from cache import TTLCache
+from revocation import RevocationList, LocalBackend
+import signing
+from ratelimit import LocalCounters, SharedCounters
+from signing import KeyRing
+from validation import EMAIL_REGEX, PASSWORD_REGEX, check_email_format, check_password_format
 
 
 EMAIL = 'alice@example.com'
@@ -23,9 +49,445 @@ def test_password_function_compatible():
     assert verify_password('P@ssw0rdOK', '$2b$12$ElKEYvzzbadvQEn39F7xdOuZfR0qRDdYykfJTr4YgR8OkF.wc0f3G')
 
 
+def password_schemes():
+    schemes = [BcryptScheme(4), ScryptScheme(10, 8, 1)]
+    if passwords.argon2 is not None:
+        schemes.append(Argon2Scheme(1, 8192, 1))
+    return schemes
+
+
+def test_password_policy():
+    schemes = password_schemes()
+    for scheme in schemes:
+        policy = PasswordPolicy(scheme, schemes)
+        hashed_password = policy.hash(PASSWORD)
+        assert policy.identify(hashed_password) is scheme
+        assert policy.verify(PASSWORD, hashed_password)
+        assert not policy.verify('wrong' + PASSWORD, hashed_password)
+        assert not policy.needs_rehash(hashed_password)
+        # legacy bcrypt hash stays valid, rehashed unless it is the current scheme and cost
+        assert policy.verify(PASSWORD, HPASSWORD)
+        assert policy.needs_rehash(HPASSWORD)
+
+
+def test_password_policy_cost_change():
+    for old, new in [(BcryptScheme(4), BcryptScheme(5)), (ScryptScheme(10, 8, 1), ScryptScheme(11, 8, 1))]:
+        hashed_password = old.hash(PASSWORD)
+        policy = PasswordPolicy(new, [new])
+        assert policy.verify(PASSWORD, hashed_password)
+        assert policy.needs_rehash(hashed_password)
+    assert not PasswordPolicy(BcryptScheme(4), [BcryptScheme(4)]).verify(PASSWORD, '$unknown$')
+
+
 def test_jwt_token():
     token = generate_jwt_token(EMAIL)
     payload = validate_jwt_token(token)
 
     assert payload.get('email') == EMAIL
     assert payload.get('exp') - payload.get('iat') == DEFAULT_TOKEN_EXPIRY
+
+
+def test_jwt_token_cached():
+    token = generate_jwt_token(EMAIL)
+    assert validate_jwt_token_cached(token) == validate_jwt_token(token)
+    assert validate_jwt_token_cached(token + 'x') is None
+
+
+def pemkey(algorithm):
+    from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
+    from cryptography.hazmat.primitives.serialization import Encoding, PrivateFormat, NoEncryption
+    if algorithm == 'RS256':
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    elif algorithm == 'ES256':
+        key = ec.generate_private_key(ec.SECP256R1())
+    else:
+        key = ed25519.Ed25519PrivateKey.generate()
+    return key.private_bytes(Encoding.PEM, PrivateFormat.PKCS8, NoEncryption())
+
+
+@pytest.mark.skipif(not signing.CRYPTOGRAPHY, reason='cryptography is not installed')
+@pytest.mark.parametrize('algorithm', ['RS256', 'ES256', 'EdDSA'])
+def test_keyring(tmp_path, algorithm):
+    (tmp_path / 'old.pem').write_bytes(pemkey(algorithm))
+    keyring = KeyRing.load(algorithm, str(tmp_path), 'old')
+    old_token = keyring.sign({'email': EMAIL})
+
+    # rotation: the new key signs, the retired key still verifies and both are published
+    (tmp_path / 'new.pem').write_bytes(pemkey(algorithm))
+    keyring = KeyRing.load(algorithm, str(tmp_path), 'new')
+    token = keyring.sign({'email': EMAIL})
+    assert signing.jwt.get_unverified_header(token)['kid'] == 'new'
+    assert keyring.verify(token)['email'] == EMAIL
+    assert keyring.verify(old_token)['email'] == EMAIL
+    jwks = keyring.jwks()['keys']
+    assert {jwk['kid'] for jwk in jwks} == {'old', 'new'}
+    assert all(jwk['alg'] == algorithm and 'd' not in jwk for jwk in jwks)
+
+    # a key from outside of the ring is rejected
+    other = KeyRing(algorithm)
+    other.use('new', signing.load_pem_private_key(pemkey(algorithm), password=None))
+    with pytest.raises(signing.jwt.InvalidTokenError):
+        keyring.verify(other.sign({'email': EMAIL}))
+
+
+def test_ttl_cache():
+    cache = TTLCache('test', 2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    # b is the least recently used entry
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+    # expired and non-positive ttl entries are never served
+    cache.set('d', 4, ttl=-1)
+    assert cache.get('d') is None
+    assert cache.stats() == {'size': 2, 'maxsize': 2, 'hits': 2, 'misses': 2, 'evictions': 1}
+
+
+def test_hasher_pool():
+    pool = HasherPool('THREAD', 1, 1)
+    hashed_password = pool.hash_password(PASSWORD)
+    assert isinstance(hashed_password, str)
+    assert pool.verify_password(PASSWORD, hashed_password)
+    assert pool.verify_password(PASSWORD, HPASSWORD)
+    pool.shutdown()
+
+
+def test_hasher_pool_admission():
+    pool = HasherPool('THREAD', 1, 1)
+    release = threading.Event()
+    # one job running, one job waiting: the pool is at capacity
+    running = [pool.submit(release.wait), pool.submit(release.wait)]
+    with pytest.raises(HasherBusy):
+        pool.submit(release.wait)
+    assert pool.rejected == 1
+
+    release.set()
+    for future in running:
+        future.result()
+    assert pool.verify_password(PASSWORD, HPASSWORD)
+    pool.shutdown()
+
+
+def test_bulk_textstream():
+    # lines and utf-8 characters split across the chunks of the body, csv quoted newlines kept
+    chunks = ['email,password\n"al\nice@exa'.encode(), 'mple.com",pé'.encode()[:-1], 'pé'.encode()[-1:] + b'\r\nbob,x']
+    assert list(bulk.textstream(chunks)) == ['email,password\n', '"al\n', 'ice@example.com",pé\r\n', 'bob,x']
+    rows = bulk.BulkImport(None, 'csv').parse(bulk.textstream(chunks))
+    assert list(rows) == [{'email': 'al\nice@example.com', 'password': 'pé'}, {'email': 'bob', 'password': 'x'}]
+
+
+def test_bulk_hasher_share(monkeypatch):
+    # the import never hold more than its share of the hasher, the hashes come back in order
+    pool = HasherPool('THREAD', 4, 0)
+    lock, running, peak = threading.Lock(), [0], [0]
+    def hashpw(plain_password):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        return plain_password.upper()
+    monkeypatch.setattr(bulk, 'hasher', pool)
+    monkeypatch.setattr(bulk, 'hashpw', hashpw)
+    importer = bulk.BulkImport(None)
+    assert importer.share == 2
+    plains = [f'p{i}' for i in range(20)]
+    assert list(importer.hash_passwords(plains)) == [plain.upper() for plain in plains]
+    assert peak[0] <= 2
+    assert pool.rejected == 0
+    pool.shutdown()
+
+
+def test_revocation_list():
+    backend = LocalBackend()
+    revocations = RevocationList(backend)
+    revocations.revoke(EMAIL)
+    notbefore = revocations._notbefore[EMAIL][0]
+    # millisecond resolution: a token of the same second, issued before or with the revocation, is revoked
+    assert revocations.is_revoked({'email': EMAIL, 'iat': notbefore // 1000, 'iat_ms': notbefore})
+    assert not revocations.is_revoked({'email': EMAIL, 'iat': notbefore // 1000, 'iat_ms': notbefore + 1})
+    # without iat_ms, issued at the start of its second
+    assert revocations.is_revoked({'email': EMAIL, 'iat': notbefore // 1000})
+    assert not revocations.is_revoked({'email': EMAIL, 'iat': notbefore // 1000 + 1})
+    assert not revocations.is_revoked({'email': 'bob@example.com', 'iat_ms': notbefore - 1})
+
+    # another worker learn the revocation from the shared backend
+    worker = RevocationList(backend)
+    worker.sync()
+    assert worker.is_revoked({'email': EMAIL, 'iat_ms': notbefore - 1})
+
+
+def test_account_cache_staleness(monkeypatch):
+    monkeypatch.setattr(database, 'account_cache', TTLCache('account_test', 100, 30))
+    monkeypatch.setattr(database, 'replicas', None)
+    dbsess = SessionLocal()
+    assert database.create_account(dbsess, 'stale@example.com', HPASSWORD)
+    # the previous hash, cached before the password was changed by another worker
+    database.cache_account('stale@example.com', AccountRecord(1, 'stale@example.com', 'previous'))
+    assert database.get_account(dbsess, 'stale@example.com', stale=True).hpassword == 'previous'
+    # a password check reads the primary
+    assert database.get_account(dbsess, 'stale@example.com').hpassword == HPASSWORD
+    # the revocation of the other worker evicts the cached account
+    backend = LocalBackend()
+    RevocationList(backend).revoke('stale@example.com')
+    database.cache_account('stale@example.com', AccountRecord(1, 'stale@example.com', 'previous'))
+    worker = RevocationList(backend)
+    worker.sync()
+    assert database.cached_account('stale@example.com') is None
+    # unknown email, served by the cache to every lookup
+    database.cache_account('unknown@example.com', None)
+    assert database.cached_account('unknown@example.com') is False and database.get_account(dbsess, 'unknown@example.com') is None
+    database.delete_account(dbsess, database.get_account(dbsess, 'stale@example.com'))
+    dbsess.close()
+
+
+# inputs around the edges of the patterns: trailing newline, non ascii digits and letters, '|' of the tld class
+FUZZ_CHARS = 'aZ09._%+-@|!#$^&*\n \u0663\u00e9'
+
+
+def test_validation_matches_regex():
+    rng = random.Random(20)
+    cases = ['alice@example.com', 'a@b.cc', 'a@b.c', 'a@b.cc\n', 'a@b.cc\n\n', 'a@.cc', 'a@b.c|', 'a@b..cc', '@b.cc', 'a@@b.cc',
+             'P@ssw0rdOK', 'P@ssw0rdOK\n', 'P@ss\u0663ord', 'Aa1!' * 8, 'Aa1!' * 8 + 'a', 'Aa1!' * 8 + '\n', 'Aa1!' * 2, '', '\n']
+    cases += [''.join(rng.choice(FUZZ_CHARS) for _ in range(rng.randint(0, 40))) for _ in range(20000)]
+    # valid shapes with one random mutation, to reach the accepted side of the patterns
+    for base in ['john.doe+test@sub.example.org', 'P@ssw0rdOK1234']:
+        for _ in range(5000):
+            i = rng.randrange(len(base) + 1)
+            cases.append(base[:i] + rng.choice(FUZZ_CHARS) + base[i + rng.randint(0, 1):])
+    for case in cases:
+        assert check_email_format(case) == bool(re.match(EMAIL_REGEX, case)), case
+        assert check_password_format(case) == bool(re.match(PASSWORD_REGEX, case)), case
+    assert any(check_email_format(case) for case in cases) and any(check_password_format(case) for case in cases)
+    # oversized input is rejected by its length
+    assert not check_password_format('Aa1!' * 100000)
+    assert check_email_format('a' * 240 + '@example.com') and not check_email_format('a' * 243 + '@example.com')
+    assert not check_email_format('a' * 100000 + '@example.com')
+
+
+def test_claims_pipeline(monkeypatch):
+    account = AccountRecord(7, EMAIL, HPASSWORD, 'admin,ops', 3)
+    monkeypatch.setattr(claims, 'enrichers', claims.pipeline(['uid', 'roles', 'ver']))
+    assert claims.account_claims(account) == {'uid': 7, 'roles': ['admin', 'ops'], 'ver': 3}
+    # a custom enricher, without any way to override the registered claims
+    claims.enricher('tenant')(lambda account: {'tenant': 'acme', 'exp': 0})
+    monkeypatch.setattr(claims, 'enrichers', claims.pipeline(['uid', 'tenant']))
+    assert claims.account_claims(account) == {'uid': 7, 'tenant': 'acme'}
+    token = TokenClaims.construct(**validate_jwt_token(generate_jwt_token(EMAIL, claims.account_claims(account))))
+    assert token.uid == 7 and token.tenant == 'acme' and token.roles == [] and not token.has_role('admin')
+    del claims.ENRICHERS['tenant']
+
+
+def test_replica_routing(tmp_path, monkeypatch):
+    replicaset = ReplicaSet([f'sqlite:///{tmp_path}/replica1.db', f'sqlite:///{tmp_path}/replica2.db'], 'ROUND_ROBIN', sticky=5, async_engines=False)
+    for engine in replicaset.engines:
+        Base.metadata.create_all(bind=engine)
+        with engine.begin() as connection:
+            connection.execute(AccountBase.__table__.insert(), {'email': 'replica@example.com', 'hpassword': 'replicated'})
+    monkeypatch.setattr(database, 'replicas', replicaset)
+    monkeypatch.setattr(database, 'account_cache', TTLCache('account_test', 100, 30))
+    dbsess = SessionLocal()
+    # replica only for the lookups which allow it, the primary does not have this account,
+    # a replica row is not cached where the password check of login would read it
+    assert database.get_account(dbsess, 'replica@example.com', stale=True).hpassword == 'replicated'
+    assert database.cached_account('replica@example.com') is None
+    assert database.get_account(dbsess, 'replica@example.com') is None
+    monkeypatch.setattr(database, 'account_cache', None)
+    # not replicated yet: found on the primary
+    assert database.create_account(dbsess, 'lagging@example.com', HPASSWORD)
+    replicaset.recent = None
+    assert database.get_account(dbsess, 'lagging@example.com', stale=True).hpassword == HPASSWORD
+    # read-after-write: the account written by this worker is read from the primary
+    replicaset.recent = TTLCache('replica_sticky', 100, 5)
+    database.invalidate_account('replica@example.com')
+    assert database.get_account(dbsess, 'replica@example.com', stale=True) is None
+    database.delete_account(dbsess, database.get_account(dbsess, 'lagging@example.com'))
+    dbsess.close()
+
+    # round robin, least connections, and a failing replica skipped
+    assert [replicaset.pick(replicaset.engines) for _ in range(4)] == [0, 1, 0, 1]
+    replicaset.policy = 'LEAST_CONNECTIONS'
+    with replicaset.engines[0].connect():
+        assert replicaset.pick(replicaset.engines) == 1
+    replicaset.failed(1, Exception('down'))
+    assert replicaset.pick(replicaset.engines) == 0
+    replicaset.failed(0, Exception('down'))
+    assert replicaset.pick(replicaset.engines) is None and replicaset.first(database.SELECT_ACCOUNT, {'email': EMAIL}) is None
+    broken = ReplicaSet([f'sqlite:///{tmp_path}/missing/replica.db'], async_engines=False)
+    assert broken.first(database.SELECT_ACCOUNT, {'email': EMAIL}) is None and broken.pick(broken.engines) is None
+    # a pool timeout is a failing replica as well, not an error of the request
+    saturated = ReplicaSet([f'sqlite:///{tmp_path}/replica1.db'], async_engines=False)
+    def timeout():
+        raise PoolTimeoutError('QueuePool limit reached')
+    monkeypatch.setattr(saturated.engines[0], 'connect', timeout)
+    assert saturated.first(database.SELECT_ACCOUNT, {'email': EMAIL}) is None and saturated.pick(saturated.engines) is None
+
+
+def test_migrate(tmp_path):
+    # database of an older release: accounts without hpassword, no refresh_tokens table
+    engine = create_engine(f'sqlite:///{tmp_path}/old.db')
+    with engine.begin() as connection:
+        connection.exec_driver_sql('CREATE TABLE accounts (id INTEGER PRIMARY KEY, email VARCHAR(320))')
+    applied = migrate(engine)
+    assert applied == ['ALTER TABLE accounts ADD COLUMN hpassword VARCHAR(255)',
+                       'ALTER TABLE accounts ADD COLUMN roles VARCHAR(255)',
+                       "ALTER TABLE accounts ADD COLUMN token_version INTEGER DEFAULT '0' NOT NULL"]
+    assert {'accounts', 'revocations', 'refresh_tokens'} <= set(inspect(engine).get_table_names())
+    assert migrate(engine) == []
+
+
+def test_release(tmp_path):
+    # the pooled connections are closed before the workers are forked, an in-memory database keeps its connection
+    url = f'sqlite:///{tmp_path}/release.db'
+    engine = create_engine(url, **database.engine_options(url, database.MeteredQueuePool))
+    Base.metadata.create_all(bind=engine)
+    assert database.pool_stats(engine)['checkedin'] == 1
+    database.release(engine)
+    assert database.pool_stats(engine)['checkedin'] == 0
+    memory = create_engine('sqlite://', **database.engine_options('sqlite://', database.MeteredQueuePool))
+    Base.metadata.create_all(bind=memory)
+    database.release(memory)
+    assert 'accounts' in inspect(memory).get_table_names()
+
+
+def test_supervisor_scale(monkeypatch):
+    # the number of active workers follows the target, a retiring worker is replaced at once
+    supervisor = Supervisor(None, 3)
+    spawned = iter(range(100, 200))
+    killed = []
+    monkeypatch.setattr(supervisor, 'spawn', lambda: supervisor.pids.add(next(spawned)))
+    monkeypatch.setattr(os, 'kill', lambda pid, sig: killed.append(pid))
+    supervisor.scale()
+    assert supervisor.pids == {100, 101, 102}
+    supervisor.workers = 2
+    supervisor.scale()
+    assert killed == [100] and supervisor.retiring == {100}
+    supervisor.kill(101)
+    supervisor.scale()
+    assert supervisor.pids - supervisor.retiring == {102, 103}
+    assert rss(os.getpid()) > 0
+
+
+def test_supervisor_backoff(monkeypatch):
+    # a worker failing at startup leaves its process with an error, never through the supervisor code,
+    # and its replacement is delayed
+    class FailingServer:
+        def __init__(self, config):
+            raise RuntimeError('startup failure')
+
+    supervisor = Supervisor(None, 1)
+    supervisor.pipe = os.pipe()
+    exited = []
+    monkeypatch.setattr(supervisor_module.uvicorn, 'Server', FailingServer)
+    monkeypatch.setattr(supervisor_module, 'logger', type('Logger', (), {'error': exited.append, 'warning': exited.append, 'info': exited.append})())
+    supervisor.scale()
+    while supervisor.pids:
+        supervisor.reap()
+        time.sleep(0.01)
+    assert 'exitcode=1' in str(exited[-1]) and 'backoff=0.5' in str(exited[-1])
+    assert supervisor.failures == 1 and supervisor.holdoff > time.monotonic()
+    supervisor.scale()
+    assert not supervisor.pids
+    for fd in supervisor.pipe:
+        os.close(fd)
+
+
+def test_ratelimit_counters(tmp_path):
+    for counters in [LocalCounters(60, 1024), SharedCounters(60, 1024, str(tmp_path / 'ratelimit'))]:
+        now = 6000
+        assert all(counters.hit('ip:10.0.0.1', 3, now + i) for i in range(3))
+        assert not counters.hit('ip:10.0.0.1', 3, now + 3)
+        assert counters.hit('ip:10.0.0.2', 3, now + 3)
+        # half of the previous window still counts in the sliding window, then nothing
+        assert counters.hit('ip:10.0.0.1', 3, now + 90) and counters.hit('ip:10.0.0.1', 3, now + 90)
+        assert not counters.hit('ip:10.0.0.1', 3, now + 90)
+        assert counters.hit('ip:10.0.0.1', 3, now + 300)
+
+    # counters of the shared backend are seen by every instance mapping the file
+    first, second = SharedCounters(60, 1024, str(tmp_path / 'shared')), SharedCounters(60, 1024, str(tmp_path / 'shared'))
+    assert first.hit('email:a@example.com', 2, 6000) and second.hit('email:a@example.com', 2, 6000)
+    assert not first.hit('email:a@example.com', 2, 6000)
+
+
+def test_ratelimit_shared_collision(tmp_path):
+    # the digest secret is created with the file, shared by the instances mapping it
+    first, second = SharedCounters(60, 1024, str(tmp_path / 'shared')), SharedCounters(60, 1024, str(tmp_path / 'shared'))
+    other = SharedCounters(60, 1024, str(tmp_path / 'other'))
+    first.open(), second.open(), other.open()
+    assert first._key == second._key != other._key
+
+    # a single bucket: 4 keys fill it, a fifth one is counted against the busiest and never resets a live counter
+    counters = SharedCounters(60, 4, str(tmp_path / 'bucket'))
+    for i in range(4):
+        assert counters.hit(f'ip:10.0.0.{i}', 2, 6000) and counters.hit(f'ip:10.0.0.{i}', 2, 6000)
+    assert not counters.hit('ip:10.0.0.9', 2, 6000)
+    assert not any(counters.hit(f'ip:10.0.0.{i}', 2, 6000) for i in range(4))
+    # expired counters free their slots
+    assert counters.hit('ip:10.0.0.9', 2, 6200)
+
+
+def test_ratelimit_shared_contended(tmp_path):
+    # a bucket locked by another worker is never waited for, the hit is counted by the counters of this worker
+    counters = SharedCounters(60, 4, str(tmp_path / 'contended'))
+    counters.open()
+    locked, release = os.pipe(), os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        fcntl.lockf(counters._fd, fcntl.LOCK_EX)
+        os.write(locked[1], b'1')
+        os.read(release[0], 1)
+        os._exit(0)
+    os.read(locked[0], 1)
+    assert counters.hit('ip:10.0.0.1', 2, 6000) and counters.hit('ip:10.0.0.1', 2, 6000)
+    assert not counters.hit('ip:10.0.0.1', 2, 6000)
+    assert counters.contended == 3
+    os.write(release[1], b'1')
+    os.waitpid(pid, 0)
+    assert counters.hit('ip:10.0.0.1', 2, 6000) and counters.contended == 3
+    for fd in locked + release:
+        os.close(fd)
+
+
+def test_ratelimit_local_eviction():
+    counters = LocalCounters(60, 1024)
+    for i in range(5000):
+        counters.hit(f'ip:{i}', 3, 6000)
+    assert len(counters._counters) == 1024
+    counters.hit('ip:new', 3, 6200)
+    assert len(counters._counters) == 1
+
+
+def test_structured_message():
+    assert str(kv(module='auth', space='test', status_code=200)) == 'module=auth, space=test, status_code=200'
+
+
+def test_log_queue_drop_policy():
+    def record(message):
+        return logging.LogRecord('auth', logging.INFO, __file__, 0, message, None, None)
+
+    handler = NonBlockingQueueHandler(queue.Queue(1), 'DROP_NEW')
+    handler.handle(record('first'))
+    handler.handle(record('second'))
+    assert handler.dropped == 1
+    assert handler.queue.get_nowait().msg == 'first'
+
+    handler = NonBlockingQueueHandler(queue.Queue(1), 'DROP_OLD')
+    handler.handle(record('first'))
+    handler.handle(record('second'))
+    assert handler.dropped == 1
+    assert handler.queue.get_nowait().msg == 'second'
+
+
+def test_debug_sampled(monkeypatch):
+    level = logger.level
+    logger.setLevel(logging.INFO)
+    assert not debug_sampled('/auth/login')
+
+    logger.setLevel(logging.DEBUG)
+    monkeypatch.setattr('utils.DEBUG_SAMPLING_ROUTES', {'/auth/login': 0.0, '/auth/users': 1.0})
+    assert not debug_sampled('/auth/login')
+    assert debug_sampled('/auth/users')
+    logger.setLevel(level)
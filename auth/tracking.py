@@ -0,0 +1,85 @@
+import os
+import re
+import itertools
+import traceback
+from time import perf_counter
+from starlette.responses import PlainTextResponse
+
+from utils import logger, kv, _request_uuid_ctx_var
+from metrics import REQUESTS, REQUEST_LATENCY
+
+
+# accepted incoming X-Request-ID, anything else is replaced so it can not forge the log lines
+REQUEST_ID_REGEX = re.compile(r'[A-Za-z0-9._:-]{1,128}')
+
+
+class RequestIdGenerator:
+    # <random prefix of the process>-<counter in hex>: unique across the workers and restarts,
+    # a counter increment instead of reading 16 random bytes and formatting an uuid per request
+    def __init__(self):
+        self.reset()
+        if hasattr(os, 'register_at_fork'):
+            # a forked worker must not continue the sequence of its parent
+            os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        self._prefix = os.urandom(6).hex()
+        self._counter = itertools.count(1)
+
+    def __call__(self):
+        return f'{self._prefix}-{next(self._counter):x}'
+
+
+class TrackingMiddleware:
+    # pure asgi middleware: request id, access log line and http metrics of every request.
+    # no task nor stream is interposed between the server and the application, only send is wrapped
+    # to capture the status code and to return the request id.
+    def __init__(self, app):
+        self.app = app
+        self.request_id = RequestIdGenerator()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start_time = perf_counter()
+        request_id = None
+        for name, value in scope['headers']:
+            if name == b'x-request-id':
+                request_id = value.decode('latin-1')
+                break
+        if request_id is None or not REQUEST_ID_REGEX.fullmatch(request_id):
+            request_id = self.request_id()
+        token = _request_uuid_ctx_var.set(request_id)
+        status_code = 500
+        started = False
+
+        async def tracked_send(message):
+            nonlocal status_code, started
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+                started = True
+                message['headers'] = list(message.get('headers', [])) + [(b'x-request-id', request_id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, tracked_send)
+        except Exception as e:
+            # logged with the request id, the 500 is sent here so it carries the request id as well,
+            # the server error middleware then only re-raise to the server
+            logger.error(kv(module='auth', space='httpapi', request_id=request_id, path=scope['path'], exception=e, traceback=traceback.format_exc()))
+            if not started:
+                await PlainTextResponse('Internal Server Error', status_code=500)(scope, receive, tracked_send)
+            raise
+        finally:
+            elapsed = perf_counter() - start_time
+            method = scope['method'].lower()
+            # label by endpoint rather than raw path, keep the metrics cardinality bounded
+            endpoint = scope.get('endpoint')
+            handler = endpoint.__name__ if endpoint else 'none'
+            REQUESTS.labels(handler, method, status_code).inc()
+            REQUEST_LATENCY.labels(handler, method).observe(elapsed)
+            client = scope.get('client')
+            logger.info(kv(module='auth', space='httpapi', request_id=request_id, client_ip=client[0] if client else None, method=method, path=scope['path'], status_code=status_code, process_time=round(elapsed, 3)))
+            _request_uuid_ctx_var.reset(token)
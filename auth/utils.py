@@ -1,13 +1,22 @@
+import os
 import sys
-import re
+import atexit
+import queue
 import logging
-from logging.handlers import TimedRotatingFileHandler
-from datetime import datetime, timedelta
+import hashlib
+import secrets
+from time import time
+from random import random
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
 import jwt
 import bcrypt
 from contextvars import ContextVar
 
-from config import LOGGOUTPUT, LOGLEVEL, SECRET_KEY, DEFAULT_TOKEN_EXPIRY
+from config import LOGGOUTPUT, LOGLEVEL, LOGGQUEUE, LOGGQUEUE_SIZE, LOGGQUEUE_POLICY, DEBUG_SAMPLING_RATE, DEBUG_SAMPLING_ROUTES, BCRYPT_ROUNDS, SECRET_KEY, JWT_ALGORITHM, JWT_KEYS_DIR, JWT_SIGNING_KID, DEFAULT_TOKEN_EXPIRY, REFRESH_TOKEN_EXPIRY, TOKEN_CACHE_SIZE
+from cache import TTLCache
+from signing import KeyRing
+# kept importable from utils
+from validation import EMAIL_REGEX, PASSWORD_REGEX, check_email_format, check_password_format
 
 
 _request_uuid_ctx_var: ContextVar[str] = ContextVar('request_uuid', default=None)
@@ -15,6 +24,49 @@ def get_request_uuid() -> str:
     return _request_uuid_ctx_var.get()
 
 
+class StructuredMessage:
+    # log message as key/value fields, rendered as "key=value, key=value" only when the record is written
+    __slots__ = ('fields',)
+
+    def __init__(self, **fields):
+        self.fields = fields
+
+    def __str__(self):
+        return ', '.join(f'{key}={value}' for key, value in self.fields.items())
+
+kv = StructuredMessage
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    # put the record in a bounded queue, formatting and io are done by the listener thread
+    def __init__(self, queue, policy):
+        super().__init__(queue)
+        self.policy = policy
+        self.dropped = 0
+
+    def prepare(self, record):
+        # the default implementation format the message on the caller thread
+        return record
+
+    def enqueue(self, record):
+        if self.policy == 'BLOCK':
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            if self.policy == 'DROP_OLD':
+                try:
+                    self.queue.get_nowait()
+                    self.queue.put_nowait(record)
+                except (queue.Empty, queue.Full):
+                    pass
+
+
+# queue listeners of the loggers, see flush_logs
+LISTENERS = []
+
 def getlogger(name):
     _logger = logging.getLogger(name)
 
@@ -30,14 +82,36 @@ def getlogger(name):
         _logger.setLevel(logging.INFO)
 
     FORMATTER = logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s")
+    handlers = []
     if LOGGOUTPUT in ['CONSOLE', 'ALL']:
         console_handler = logging.StreamHandler(sys.stdout)
         console_handler.setFormatter(FORMATTER)
-        _logger.addHandler(console_handler)
+        handlers.append(console_handler)
     if LOGGOUTPUT in ['FILE', 'ALL']:
         file_handler = TimedRotatingFileHandler('auth.log', when='midnight')
         file_handler.setFormatter(FORMATTER)
-        _logger.addHandler(file_handler)
+        handlers.append(file_handler)
+
+    if LOGGQUEUE:
+        queue_handler = NonBlockingQueueHandler(queue.Queue(LOGGQUEUE_SIZE), LOGGQUEUE_POLICY)
+        _logger.addHandler(queue_handler)
+        listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+        listener.start()
+        LISTENERS.append(listener)
+        # flush the remaining records at exit
+        atexit.register(listener.stop)
+
+        def restart_listener():
+            # the listener thread does not survive a fork (preload mode), the worker gets its own queue and thread
+            queue_handler.queue = listener.queue = queue.Queue(LOGGQUEUE_SIZE)
+            listener._thread = None
+            listener.start()
+
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=restart_listener)
+    else:
+        for handler in handlers:
+            _logger.addHandler(handler)
 
     # with this pattern, it's rarely necessary to propagate the error up to parent
     _logger.propagate = False
@@ -46,6 +120,22 @@ def getlogger(name):
 logger = getlogger('auth')
 
 
+def flush_logs():
+    # write the queued records and flush the handlers, for a process leaving by os._exit without the atexit handlers
+    for listener in LISTENERS:
+        if listener._thread is not None:
+            listener.stop()
+    logging.shutdown()
+
+
+def debug_sampled(path):
+    # debug is enabled and this request of the route is picked by the sampling rate
+    if not logger.isEnabledFor(logging.DEBUG):
+        return False
+    rate = DEBUG_SAMPLING_ROUTES.get(path, DEBUG_SAMPLING_RATE)
+    return rate >= 1 or random() < rate
+
+
 def reqinspect(http_request):
     # inspect the http request
     try:
@@ -59,48 +149,94 @@ def reqinspect(http_request):
         return {}
 
 
-EMAIL_REGEX = re.compile(r'^[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}$')
-PASSWORD_REGEX = re.compile(r'^(?=.*[A-Za-z])(?=.*\d)(?=.*[!@#$%^&*_-])[A-Za-z\d!@#$%^&*_-]{8,32}$')
+def get_hashed_password(plain_password, rounds=BCRYPT_ROUNDS):
+    return bcrypt.hashpw(plain_password.encode(), bcrypt.gensalt(rounds))
 
-def check_email_format(email):
-    # The better way is to send them an email and ask them click a link to verify
-    # This only able to verify that the email address is syntactically valid. In this assigment just do this way.
-    if (re.match(EMAIL_REGEX, email)):
-        return True
-    else:
-        return False
 
+def verify_password(plain_password, hashed_password):
+    return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
+
+
+keyring = None
+if JWT_ALGORITHM == 'HS256':
+    if not SECRET_KEY:
+        logger.critical(kv(module='auth', space='security', error='Please specify SECRET_KEY'))
+        exit()
+else:
+    try:
+        keyring = KeyRing.load(JWT_ALGORITHM, JWT_KEYS_DIR, JWT_SIGNING_KID)
+        logger.info(kv(module='auth', space='security', action='keyring', algorithm=JWT_ALGORITHM, signing_kid=keyring.signing_kid, kids=keyring.kids()))
+    except Exception as e:
+        logger.critical(kv(module='auth', space='security', error=f'Unable to load the {JWT_ALGORITHM} keys of {JWT_KEYS_DIR}', exception=e))
+        exit()
 
-def check_password_format(password):
-    if (re.match(PASSWORD_REGEX, password)):
-        return True
+
+def encode_jwt(payload):
+    if keyring is None:
+        token = jwt.encode(payload, SECRET_KEY, algorithm='HS256')
     else:
-        return False
+        token = keyring.sign(payload)
+    # PyJWT 1.x return bytes, the token is always handled as string
+    return token.decode() if isinstance(token, bytes) else token
 
 
-def get_hashed_password(plain_password):
-    return bcrypt.hashpw(plain_password.encode(), bcrypt.gensalt())
+def decode_jwt(credentials):
+    if keyring is None:
+        return jwt.decode(credentials, SECRET_KEY, algorithms=['HS256'])
+    return keyring.verify(credentials)
 
 
-def verify_password(plain_password, hashed_password):
-    return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
+def generate_jwt_token(email, claims=None):
+    # claims: extra claims of the account (claims pipeline), the registered claims take precedence.
+    # iat_ms: issue time in millisecond, compared with the not-before of the revocations
+    created = int(time() * 1000)
+    issued = {"iat": created // 1000, "iat_ms": created, "exp": created // 1000 + DEFAULT_TOKEN_EXPIRY, "email": email}
+    payload = {**claims, **issued} if claims else issued
+    return encode_jwt(payload)
 
 
-if not SECRET_KEY:
-    logger.critical('module=auth, space=security, error=Please specify SECRET_KEY')
-    exit()
+def generate_refresh_token(family=None):
+    # long lived, single use token only accepted by /auth/refresh: opaque <family>.<secret>, not a jwt,
+    # so no service verifying the access tokens can take it for one. the database only stores the digest
+    # of the secret (jti), every token rotated from the same login share the family id
+    secret = secrets.token_urlsafe(32)
+    family = family or secrets.token_hex(16)
+    return f'{family}.{secret}', refresh_token_digest(secret), family, int(time()) + REFRESH_TOKEN_EXPIRY
 
-def generate_jwt_token(email):
-    created = datetime.utcnow()
-    expiry =  created + timedelta(seconds=DEFAULT_TOKEN_EXPIRY)
-    payload = {"iat": created, "exp": expiry, "email": email}
-    return jwt.encode(payload, SECRET_KEY, algorithm='HS256')
+
+def refresh_token_digest(secret):
+    return hashlib.blake2b(secret.encode(), digest_size=16).hexdigest()
+
+
+def parse_refresh_token(token):
+    # (jti, family) of a well formed refresh token, None otherwise
+    family, _, secret = token.partition('.')
+    if len(family) != 32 or len(secret) != 43 or '.' in secret:
+        return None
+    return refresh_token_digest(secret), family
 
 
 def validate_jwt_token(credentials):
     try:
-        payload = jwt.decode(credentials, SECRET_KEY, algorithms=['HS256'])
+        payload = decode_jwt(credentials)
     except:
         payload = None
 
     return payload
+
+
+token_cache = TTLCache('token', TOKEN_CACHE_SIZE) if TOKEN_CACHE_SIZE else None
+
+def validate_jwt_token_cached(credentials):
+    # same as validate_jwt_token, the verified payload is remembered until the token expiry
+    # key is a digest so the cache does not hold the bearer credentials
+    if token_cache is None:
+        return validate_jwt_token(credentials)
+
+    key = hashlib.blake2b(credentials.encode(), digest_size=16).digest()
+    payload = token_cache.get(key)
+    if payload is None:
+        payload = validate_jwt_token(credentials)
+        if payload:
+            token_cache.set(key, payload, ttl=payload.get('exp', 0) - time())
+    return payload
@@ -0,0 +1,30 @@
+import re
+
+
+# formats of the account inputs, checked on every register, login and password change.
+# an input outside the length bounds is rejected before any regex, the patterns are then matched
+# with their own compiled match, without the lookup in the pattern cache of the re module.
+EMAIL_REGEX = re.compile(r'^[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}$')
+PASSWORD_REGEX = re.compile(r'^(?=.*[A-Za-z])(?=.*\d)(?=.*[!@#$%^&*_-])[A-Za-z\d!@#$%^&*_-]{8,32}$')
+
+# shortest email matched: a@b.cc, longest one allowed by rfc 5321 (path of 256 minus the angle brackets)
+EMAIL_MIN_LENGTH = 6
+EMAIL_MAX_LENGTH = 254
+PASSWORD_MIN_LENGTH = 8
+PASSWORD_MAX_LENGTH = 32
+
+_match_email = EMAIL_REGEX.match
+_match_password = PASSWORD_REGEX.match
+
+
+def check_email_format(email):
+    # The better way is to send them an email and ask them click a link to verify
+    # This only able to verify that the email address is syntactically valid.
+    # the pattern has no nested quantifier, one scan with a backtrack bounded by the domain part
+    return EMAIL_MIN_LENGTH <= len(email) <= EMAIL_MAX_LENGTH and _match_email(email) is not None
+
+
+def check_password_format(password):
+    # the three lookaheads rescan the input, the length check bounds each scan to 33 characters
+    # instead of the whole input: '$' also matches before a trailing newline, which is accepted as before
+    return PASSWORD_MIN_LENGTH <= len(password) <= PASSWORD_MAX_LENGTH + 1 and _match_password(password) is not None